@@ -1,65 +1,368 @@
 #!/usr/bin/env python2
 
+import argparse
+import array
 import collections
-import copy
+import contextlib
+import csv
+import cStringIO
 import datetime
+import hashlib
+import itertools
 import json
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import re
 import os
-
-import bs4
-import requests
-from word2number import w2n
-
-def main():
-  timeseries_data = get_timeseries_data('https://www.health.govt.nz/news-media/media-releases', 'https://www.health.govt.nz/our-work/diseases-and-conditions/covid-19-novel-coronavirus/covid-19-current-situation/covid-19-current-cases')
-  timeseries_data = add_manual_data(timeseries_data)
-  timeseries_data = fill_in_blanks(timeseries_data)
-
+import random
+import resource
+import struct
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+# bs4, requests and word2number are imported where they're needed, so that
+# --render-only doesn't have to load them
+
+BASE_URL = 'https://www.health.govt.nz'
+MEDIA_RELEASES_PATH = '/news-media/media-releases'
+CURRENT_CASES_PATH = '/our-work/diseases-and-conditions/covid-19-novel-coronavirus/covid-19-current-situation/covid-19-current-cases'
+
+def main(args):
+  if args.migrate_cache:
+    migrate_cache_to_pack()
+    return
+
+  configure_http(timeout=args.fetch_timeout, per_host=args.per_host_connections, retries=args.fetch_retries, backoff=args.fetch_backoff)
+
+  if args.daemon:
+    run_daemon(args)
+    return
+
+  profile = None
+  extraction_cache_file = args.extraction_cache
+  summary_record_file = SUMMARY_RECORD_FILE if args.extraction_cache is not None else None
+  if args.profile:
+    profile = new_profile()
+    # Every release and snapshot needs to be extracted to be timed, unless
+    # it's only the rendering being timed
+    if not args.render_only:
+      extraction_cache_file = None
+      summary_record_file = None
+
+  with profiled(profile, 'total'):
+    if args.poll_summary and not args.render_only:
+      with profiled(profile, 'poll_summary'):
+        poll_and_update_summary_page(args.base_url + CURRENT_CASES_PATH, keep_raw=args.raw_snapshots)
+
+    formatted_data = build_output(args, extraction_cache_file, summary_record_file, profile)
+
+    with profiled(profile, 'write_output'):
+      write_output(formatted_data, args.format or ['json'])
+
+  if profile is not None:
+    write_profile_report(args.profile, profile)
+
+def build_output(args, extraction_cache_file, summary_record_file, profile=None):
+  if args.render_only:
+    with profiled(profile, 'render_only'):
+      timeseries_data = Timeseries.from_dict(render_timeseries_data(extraction_cache_file, summary_record_file))
+  else:
+    timeseries_data = Timeseries.from_dict(get_timeseries_data(args.base_url + MEDIA_RELEASES_PATH, args.base_url + CURRENT_CASES_PATH, listing_window=args.listing_window, full_crawl=args.full_crawl, fetch_concurrency=args.fetch_concurrency, revalidate_after=args.revalidate_after * 3600 if args.revalidate_after is not None else None, workers=args.workers, extraction_cache_file=extraction_cache_file, summary_record_file=summary_record_file, document_budget=args.document_budget or None, pattern_budget=args.pattern_budget or None, profile=profile))
+
+  with profiled(profile, 'add_manual_data'):
+    timeseries_data = add_manual_data(timeseries_data)
+  with profiled(profile, 'fill_in_blanks'):
+    timeseries_data = fill_in_blanks(timeseries_data)
+  with profiled(profile, 'fill_in_dates'):
+    timeseries_data = fill_in_dates(timeseries_data)
+  with profiled(profile, 'format_output'):
+    return format_output(timeseries_data)
+
+def run_daemon(args):
+  # Rather than starting from cold every hour, stay running and poll. The HTTP
+  # session, cache pack and extracted values all stay in memory between polls,
+  # so each poll only fetches and parses releases and snapshots it hasn't seen
+  # before.
+  extraction_cache_file = args.extraction_cache
+  summary_record_file = SUMMARY_RECORD_FILE if args.extraction_cache is not None else None
+
+  while True:
+    start_time = time.time()
+    # A current cases page that can't be read shouldn't stop new media
+    # releases being picked up, so it's polled separately
+    try:
+      poll_and_update_summary_page(args.base_url + CURRENT_CASES_PATH, keep_raw=args.raw_snapshots)
+    except Exception as e:
+      log('Polling the current cases page failed: %r' % e)
+
+    try:
+      written = write_output(build_output(args, extraction_cache_file, summary_record_file), args.format or ['json'])
+      if written:
+        log('Updated %s in %.1fs' % (', '.join(written), time.time() - start_time))
+    except Exception as e:
+      # Carry on and try again next time, the site being down shouldn't stop
+      # the daemon
+      log('Poll failed: %r' % e)
+
+    # Spread polls out a bit, rather than hitting the site on the dot
+    interval = args.poll_interval * 60 * (1 + random.uniform(-args.poll_jitter, args.poll_jitter))
+    time.sleep(max(0, interval - (time.time() - start_time)))
+
+def encode_json(formatted_data):
+  return json.dumps(formatted_data, indent=2, sort_keys=True)
+
+def encode_compact_json(formatted_data):
+  return json.dumps(formatted_data, separators=(',', ':'), sort_keys=True)
+
+def encode_csv(formatted_data):
+  # One row per day, with a column for each total and each source
+  totals = sorted(formatted_data['total'].keys())
+  sources = formatted_data['sources']['keys']
+  columns = [formatted_data['total'][k] for k in totals] + [formatted_data['sources']['subseries'][k] for k in sources]
+
+  output = cStringIO.StringIO()
+  writer = csv.writer(output, lineterminator='\n')
+  writer.writerow(['date'] + totals + ['sources/%s' % k for k in sources])
+  for i, date in enumerate(formatted_data['timeseries_dates']):
+    writer.writerow([date] + ['' if c[i] is None else c[i] for c in columns])
+  return output.getvalue()
+
+def encode_msgpack(formatted_data):
+  try:
+    import msgpack
+  except ImportError:
+    sys.exit('The msgpack output format needs the msgpack package installed')
+  return msgpack.packb(formatted_data, use_bin_type=True)
+
+OUTPUT_FORMATS = collections.OrderedDict([
+  ('json', ('nzl.json', encode_json)),
+  ('compact-json', ('nzl.min.json', encode_compact_json)),
+  ('csv', ('nzl.csv', encode_csv)),
+  ('msgpack', ('nzl.msgpack', encode_msgpack)),
+])
+
+def write_output(formatted_data, formats):
+  json_filename = OUTPUT_FORMATS['json'][0]
+  previous_content = None
+  if 'json' in formats and os.path.exists(json_filename):
+    with open(json_filename, 'rb') as f:
+      previous_content = f.read()
+
+  written = []
+  for output_format in formats:
+    filename, encode = OUTPUT_FORMATS[output_format]
+    content = encode(formatted_data)
+    if write_if_changed(filename, content):
+      written.append(filename)
+
+      if output_format == 'json':
+        write_if_changed(DELTA_FILE, encode_delta(DELTA_FILE, previous_content, content, formatted_data))
+        written.append(DELTA_FILE)
+  return written
+
+# Whenever nzl.json changes, this says what changed since the last version, so
+# aggregators can apply just that
+DELTA_FILE = 'nzl.delta.json'
+
+def encode_delta(delta_filename, previous_content, content, formatted_data):
+  seq = 0
+  if os.path.exists(delta_filename):
+    with open(delta_filename, 'rb') as f:
+      seq = json.load(f)['seq']
+
+  previous = flatten_output(json.loads(previous_content)) if previous_content is not None else {}
+  current = flatten_output(formatted_data)
+
+  return json.dumps({
+    'seq': seq + 1,
+    'hash': hash_body(content),
+    'previous_hash': hash_body(previous_content) if previous_content is not None else None,
+    # [date, series, value] for every value that's new or different
+    'changes': sorted([date, series, value] for (date, series), value in current.iteritems() if (date, series) not in previous or previous[(date, series)] != value),
+    # [date, series] for every value that's gone
+    'removed': sorted([date, series] for (date, series) in previous if (date, series) not in current),
+  }, sort_keys=True)
+
+def flatten_output(formatted_data):
+  # {(date, series): value} for every value in the output, with series named
+  # like total/confirmed or sources/Overseas acquired
+  series = {}
+  for k, values in formatted_data['total'].iteritems():
+    series['total/' + k] = values
+  for k, values in formatted_data['sources']['subseries'].iteritems():
+    series['sources/' + k] = values
+  for k, derived in formatted_data.get('derived', {}).iteritems():
+    series['derived/' + k] = derived['values']
+    series['derived/%s/null_mask' % k] = derived['null_mask']
+
+  flattened = {}
+  for name, values in series.iteritems():
+    for date, value in zip(formatted_data['timeseries_dates'], values):
+      flattened[(date, name)] = value
+  return flattened
+
+def write_if_changed(filename, content):
+  # Files that haven't changed are left alone, so their mtimes (and the ETags
+  # they're served with) only change when the data does. Otherwise they're
+  # replaced in one go, so nothing ever reads a half written file.
+  if os.path.exists(filename):
+    with open(filename, 'rb') as f:
+      if hash_body(f.read()) == hash_body(content):
+        return False
+
+  make_parent_dir(filename)
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    f.write(content)
+  os.rename(tmp_filename, filename)
+  return True
+
+def make_parent_dir(filename):
+  # Files derived from the cache stay plain files under data_cache/ even once
+  # it's been packed, so the directory may need creating again
+  dirname = os.path.dirname(filename)
+  if dirname and not os.path.isdir(dirname):
+    os.makedirs(dirname)
+
+def fill_in_dates(timeseries_data):
   # Muck with the data to get it into the format that's expected
   # Fill in the blanks
-  dates = sorted(timeseries_data.keys())
-
-  start_time = min([datetime.datetime.strptime(d, '%Y-%m-%d') for d in dates])
-  end_time = max([datetime.datetime.strptime(d, '%Y-%m-%d') for d in dates])
-
-  curr_time = start_time
-  prev_time = None
-  while curr_time <= end_time:
-    key = curr_time.strftime('%Y-%m-%d')
-
-    if key not in timeseries_data:
-      timeseries_data[key] = timeseries_data[prev_time.strftime('%Y-%m-%d')]
-
-    prev_time = curr_time
-    curr_time = curr_time + datetime.timedelta(days=1)
+  timeseries_data.fill_gaps()
+  return timeseries_data
 
-  dates = sorted(timeseries_data.keys())
-  values = [timeseries_data[d] for d in dates]
+def format_output(timeseries_data):
+  dates = timeseries_data.dates()
 
   # Muck with the age groups and sources data to do the right things
   source_data = munge_data_to_output(timeseries_data, dates, 'sources')
 
-  formatted_data = {
+  return {
     'timeseries_dates': dates,
     'total': {
-      'confirmed': [timeseries_data[d]['confirmed'] for d in dates],
-      'recovered': [timeseries_data[d]['recovered'] for d in dates],
-      'deaths': [timeseries_data[d].get('deaths', None) for d in dates],
-      'tested': [timeseries_data[d].get('tested', None) for d in dates],
-      'current_hospitalized': [timeseries_data[d].get('hospitalized', None) for d in dates],
-      'current_icu': [timeseries_data[d].get('icu', None) for d in dates],
+      'confirmed': timeseries_data.series('confirmed'),
+      'recovered': timeseries_data.series('recovered'),
+      'deaths': timeseries_data.series('deaths'),
+      'tested': timeseries_data.series('tested'),
+      'current_hospitalized': timeseries_data.series('hospitalized'),
+      'current_icu': timeseries_data.series('icu'),
     },
     'sources': source_data,
+    'derived': derive_series(timeseries_data),
   }
 
-  with open('nzl.json', 'w') as f:
-    json.dump(formatted_data, f, indent=2, sort_keys=True)
-
-def get_timeseries_data(media_release_base_url, current_case_url):
-  data = get_timeseries_data_media_releases(media_release_base_url)
-  data = get_timeseries_data_summary_page(data, current_case_url)
-
+def derive_series(timeseries_data):
+  # Daily changes, 7 day averages and test positivity, worked out from the
+  # totals. Alongside each series' values is a null mask, which is true for
+  # days whose value relies on a number that wasn't actually reported (the
+  # ones copied from the day before for days only the tests table has, or
+  # carried forward by fill_in_blanks and fill_in_dates) and so shouldn't be
+  # trusted.
+  derived = {}
+  for k in ('confirmed', 'recovered', 'deaths', 'tested'):
+    derived['new_' + k] = daily_deltas(timeseries_data.series(k), timeseries_data.observed(k))
+
+  for k in ('confirmed', 'tested'):
+    values, mask = derived['new_' + k]
+    derived['new_%s_7day_average' % k] = rolling_mean(values, mask, 7)
+
+  derived['test_positivity_7day'] = rolling_ratio(derived['new_confirmed'], derived['new_tested'], 7)
+
+  return dict((k, {'values': values, 'null_mask': mask}) for k, (values, mask) in derived.iteritems())
+
+def daily_deltas(values, observed):
+  deltas = [None]
+  mask = [True]
+  for i in range(1, len(values)):
+    if values[i] is None or values[i - 1] is None:
+      deltas.append(None)
+    else:
+      deltas.append(values[i] - values[i - 1])
+    mask.append(deltas[i] is None or not (observed[i] and observed[i - 1]))
+  return deltas, mask
+
+def rolling_sums(values, mask, window):
+  # Sums over the window ending on each day, None until there's a full window
+  # or while it includes a missing value
+  sums = []
+  sum_mask = []
+  total = 0
+  missing = 0
+  masked = 0
+  for i, value in enumerate(values):
+    total += value or 0
+    missing += value is None
+    masked += mask[i]
+    if i >= window:
+      total -= values[i - window] or 0
+      missing -= values[i - window] is None
+      masked -= mask[i - window]
+
+    if i < window - 1 or missing:
+      sums.append(None)
+      sum_mask.append(True)
+    else:
+      sums.append(total)
+      sum_mask.append(masked > 0)
+  return sums, sum_mask
+
+def rolling_mean(values, mask, window):
+  sums, sum_mask = rolling_sums(values, mask, window)
+  return [round(float(s) / window, 2) if s is not None else None for s in sums], sum_mask
+
+def rolling_ratio(numerator, denominator, window):
+  numerator_sums, numerator_mask = rolling_sums(numerator[0], numerator[1], window)
+  denominator_sums, denominator_mask = rolling_sums(denominator[0], denominator[1], window)
+
+  ratios = []
+  mask = []
+  for n, d, n_mask, d_mask in zip(numerator_sums, denominator_sums, numerator_mask, denominator_mask):
+    if n is None or not d:
+      ratios.append(None)
+      mask.append(True)
+    else:
+      ratios.append(round(float(n) / d, 4))
+      mask.append(n_mask or d_mask)
+  return ratios, mask
+
+def get_timeseries_data(media_release_base_url, current_case_url, listing_window=4, full_crawl=False, fetch_concurrency=8, revalidate_after=None, workers=1, extraction_cache_file=None, summary_record_file=None, document_budget=None, pattern_budget=None, profile=None):
+  with profiled(profile, 'media_releases'):
+    data = get_timeseries_data_media_releases(media_release_base_url, listing_window=listing_window, full_crawl=full_crawl, fetch_concurrency=fetch_concurrency, revalidate_after=revalidate_after, workers=workers, extraction_cache_file=extraction_cache_file, document_budget=document_budget, pattern_budget=pattern_budget, profile=profile)
+  with profiled(profile, 'summary_page'):
+    data = get_timeseries_data_summary_page(data, current_case_url, record_file=summary_record_file)
+
+  return apply_june_overrides(data)
+
+def render_timeseries_data(extraction_cache_file, summary_record_file):
+  # Put the data back together from what earlier runs extracted, without
+  # fetching or parsing anything
+  if extraction_cache_file is None or not os.path.exists(RELEASE_LIST_FILE):
+    sys.exit('Nothing has been extracted yet, run without --render-only first')
+
+  extraction_cache = load_extraction_cache(extraction_cache_file)
+  with open(RELEASE_LIST_FILE, 'rb') as f:
+    release_list = json.load(f)
+
+  records = []
+  for post_url, body_hash in release_list:
+    record = extraction_cache.get(body_hash)
+    if record is None or not extraction_record_is_current(record):
+      sys.exit('%s needs extracting again, run without --render-only first' % post_url)
+    records.append(record)
+  data = merge_media_release_records(records)
+
+  summary_records = load_extraction_cache(summary_record_file, key='file')
+  for record in summary_records.values():
+    if record['version'] != SUMMARY_EXTRACTION_VERSION:
+      sys.exit('%s needs extracting again, run without --render-only first' % record['file'])
+  data = apply_summary_records(data, [summary_records[f] for f in sorted(summary_records.keys())])
+
+  return apply_june_overrides(data)
+
+def apply_june_overrides(data):
   june_overrides = [
   # https://www.health.govt.nz/our-work/diseases-and-conditions/covid-19-novel-coronavirus/covid-19-current-situation/covid-19-current-cases/covid-19-current-cases-details
     ('2020-06-21', 3, 0),
@@ -84,253 +387,1002 @@ def get_timeseries_data(media_release_base_url, current_case_url):
     data[d]['confirmed'] += running_confirmed_total
     running_recovered_total += r
     data[d]['recovered'] += running_recovered_total
+    # These days' totals now come from the case details page, even if they
+    # started off copied
+    if 'copied' in data[d]:
+      data[d]['copied'] = [k for k in data[d]['copied'] if k not in ('confirmed', 'recovered')]
 
   return data
 
-def get_timeseries_data_summary_page(data, base_url):
+# Bump this when changing what's pulled out of the summary page snapshots
+SUMMARY_EXTRACTION_VERSION = 1
+
+SUMMARY_RECORD_FILE = 'data_cache/summary.jsonl'
+
+def get_timeseries_data_summary_page(data, base_url, record_file=None):
   test_data_cache_dir = 'data_cache/summary/'
 
-  files = os.listdir(test_data_cache_dir)
-  # Find the most recent filename, which we'll use for cumulative test data
-  most_recent_filename = sorted(files)[-1]
+  # Only snapshots that are new, or have been overwritten since they were last
+  # read, get parsed. Everything else comes from the record file.
+  records = {}
+  if record_file is not None:
+    records = load_extraction_cache(record_file, key='file')
+
+  # A day's snapshot is stored as its parsed tables (.json), the raw page
+  # (.html), or both. Sorting puts .json after .html, so the tables win.
+  snapshot_files = {}
+  for filename in sorted(cache_list(test_data_cache_dir)):
+    date, extension = os.path.splitext(filename)
+    if extension in ('.html', '.json'):
+      snapshot_files[date] = filename
+  files = [snapshot_files[date] for date in sorted(snapshot_files.keys())]
+
+  changed = False
   for filename in files:
-    body = None
-    with open(os.path.join(test_data_cache_dir, filename), 'rb') as f:
-      body = f.read()
-
-    soup = bs4.BeautifulSoup(body, 'html.parser')
-    date = filename.split('.')[0]
-    tables = [parse_table(t) for t in soup.select('table.table-style-two')]
-    summary, quarantine, dhb_total, dhb_hospitalized, age_groups, source, testing, tests_by_day_table = tables
-
-    # Populate the different case statuses
-    _, summary_data = summary
-    if date not in data:
-      data[date] = {}
-    data[date]['confirmed'] = [r[1] for r in summary_data if r[0] == 'Number of confirmed and probable cases'][0]
-    data[date]['recovered'] = [r[1] for r in summary_data if r[0] == 'Number of recovered cases'][0]
-    data[date]['deaths'] = [r[1] for r in summary_data if r[0] == 'Number of deaths'][0]
-    data[date]['hospitalized'] = [r[1] for r in summary_data if r[0] == 'Number of cases currently in hospital'][0]
-
-    # Populate cumulative test data
-    if filename == most_recent_filename:
-      _, test_data = tests_by_day_table
-      # Skip the first "lots of days" data
-      for d, _, cumulative_tests in test_data[1:]:
-        # My kingdom for consistent date formats
-        if len(d.split('-')[1]) == 3:
-          date = datetime.datetime.strptime('%s-2020' % d, '%d-%b-%Y')
-        else:
-          date = datetime.datetime.strptime('%s-2020' % d, '%d-%B-%Y')
+    body = cache_read(os.path.join(test_data_cache_dir, filename))
+    body_hash = hash_body(body)
+
+    record = records.get(filename)
+    if record is None or record['hash'] != body_hash or record['version'] != SUMMARY_EXTRACTION_VERSION:
+      records[filename] = extract_summary_snapshot(filename, body_hash, body)
+      changed = True
+
+  for filename in set(records.keys()) - set(files):
+    del records[filename]
+    changed = True
+
+  if record_file is not None and changed:
+    save_extraction_cache(record_file, records)
+
+  return apply_summary_records(data, [records[filename] for filename in files])
+
+def apply_summary_records(data, records):
+  # Populate the different case statuses
+  for record in records:
+    if record['date'] not in data:
+      data[record['date']] = {}
+    for k, v in record['summary'].iteritems():
+      data[record['date']][k] = v
+
+  # Populate cumulative test data from the most recent snapshot
+  for d, cumulative_tests in records[-1]['tests']:
+    date = datetime.datetime.strptime(d, '%Y-%m-%d')
+    if date > datetime.datetime(2020, 4, 1):
+      # If we don't have confirmed data for this day, just pull it from the
+      # previous day for now, noting which values were copied so they aren't
+      # taken as reported
+      if d not in data:
+        data[d] = {}
+        previous_date = date - datetime.timedelta(days=1)
+        for k, v in data[previous_date.strftime('%Y-%m-%d')].iteritems():
+          if k != 'copied' and k != 'tested':
+            data[d][k] = v
+        data[d]['copied'] = sorted(data[d].keys())
+
+      data[d]['tested'] = cumulative_tests
 
-        if date > datetime.datetime(2020, 4, 1):
-          # If we don't have confirmed data for this day, just pull it from the
-          # previous day for now
-          if date.strftime('%Y-%m-%d') not in data:
-            data[date.strftime('%Y-%m-%d')] = {}
-            previous_date = date - datetime.timedelta(days=1)
-            for k in data[previous_date.strftime('%Y-%m-%d')].keys():
-              data[date.strftime('%Y-%m-%d')][k] = data[previous_date.strftime('%Y-%m-%d')][k]
+  return data
 
-          data[date.strftime('%Y-%m-%d')]['tested'] = cumulative_tests
+def extract_summary_snapshot(filename, body_hash, body):
+  if filename.endswith('.json'):
+    tables = dict((name, Table.from_dict(table)) for name, table in json.loads(body)['tables'].iteritems())
+  else:
+    soup = parse_html(body, 'table.table-style-two')
+    tables = parse_tables(soup, 'table.table-style-two', SUMMARY_PAGE_TABLES)
+
+  summary = tables['summary']
+  summary_values = {
+    'confirmed': summary.get('Number of confirmed and probable cases', 'total'),
+    'recovered': summary.get('Number of recovered cases', 'total'),
+    'deaths': summary.get('Number of deaths', 'total'),
+    'hospitalized': summary.get('Number of cases currently in hospital', 'total'),
+  }
 
-    return data
+  tests = []
+  # Skip the first "lots of days" data
+  for d, _, cumulative_tests in tables['tests_by_day'].rows()[1:]:
+    # My kingdom for consistent date formats
+    if len(d.split('-')[1]) == 3:
+      date = datetime.datetime.strptime('%s-2020' % d, '%d-%b-%Y')
+    else:
+      date = datetime.datetime.strptime('%s-2020' % d, '%d-%B-%Y')
+    tests.append([date.strftime('%Y-%m-%d'), cumulative_tests])
 
-def poll_and_update_summary_page(base_url):
+  return {
+    'file': filename,
+    'date': filename.split('.')[0],
+    'hash': body_hash,
+    'version': SUMMARY_EXTRACTION_VERSION,
+    'summary': summary_values,
+    'tests': tests,
+  }
+
+def poll_and_update_summary_page(base_url, keep_raw=True):
   # Fetch latest data summary page
-  response_body = requests.get(base_url).text
+  response = http_get(base_url)
+  response.raise_for_status()
+  response_body = response.text
 
-  soup = bs4.BeautifulSoup(response_body, 'html.parser')
+  soup = parse_html(response_body, 'div.field-items', 'table.table-style-two')
   content = soup.select('div.field-items')[1].text
 
-  m = re.match(r'.*Last updated \d+:\d+ [ap]m,.(?P<date>[^.]+)\..*', content, re.MULTILINE | re.DOTALL)
+  m = re.match(r'.*Last updated (?P<time>\d+:\d+ [ap]m),.(?P<date>[^.]+)\..*', content, re.MULTILINE | re.DOTALL)
   date = datetime.datetime.strptime(m.group('date'), '%d %B %Y')
 
-  summary_file = 'data_cache/summary/' + date.strftime('%Y-%m-%d') + '.html'
-  with open(summary_file, 'wb') as f:
-    f.write(response_body.encode('utf-8'))
+  # Only the tables are ever read back, so they're what gets stored, already
+  # parsed. The page itself is kept as well unless keep_raw is off.
+  tables = parse_tables(soup, 'table.table-style-two', SUMMARY_PAGE_TABLES)
+  snapshot = {
+    'last_updated': '%s, %s' % (m.group('time'), m.group('date')),
+    'tables': dict((name, table.to_dict()) for name, table in tables.iteritems()),
+  }
 
-def parse_table(t):
-  headers = [th.text for th in t.select('tr th')]
-  data = []
-  for tr in t.select('tr')[1:]:
-    data_cells = tr.select('th,td')
+  # Polls that find the same tables as the day's snapshot already has leave it
+  # alone
+  summary_file = 'data_cache/summary/' + date.strftime('%Y-%m-%d')
+  if cache_exists(summary_file + '.json'):
+    existing = json.loads(cache_read(summary_file + '.json'))
+    if json.dumps(existing['tables'], sort_keys=True) == json.dumps(snapshot['tables'], sort_keys=True):
+      return
+
+  cache_write(summary_file + '.json', json.dumps(snapshot, sort_keys=True))
+  if keep_raw:
+    cache_write(summary_file + '.html', response_body.encode('utf-8'))
+  flush_cache()
+
+http_session = None
+
+# timeout is in seconds, per_host is the most connections open to any one host
+# at once, and failed requests are retried up to retries times, backing off
+# exponentially (backoff * 2^n seconds) after the first retry
+http_options = {
+  'timeout': 30,
+  'per_host': 4,
+  'retries': 3,
+  'backoff': 1,
+}
+
+def configure_http(**options):
+  # The session is only replaced if the options actually change, so one
+  # shared by tools/run_hourly.py survives scripts configuring their defaults
+  global http_session
+  if any(http_options.get(k) != v for k, v in options.iteritems()):
+    http_options.update(options)
+    http_session = None
+
+def get_http_session():
+  # One session for the whole run, so connections to the same host are pooled
+  # and kept alive rather than re-established for every request
+  global http_session
+  if http_session is None:
+    import requests
+    import requests.adapters
+    from requests.packages.urllib3.util.retry import Retry
+
+    http_session = requests.Session()
+    # pool_block makes threads wait for one of the host's connections to free
+    # up, rather than opening more than per_host of them
+    adapter = requests.adapters.HTTPAdapter(
+      pool_connections=4,
+      pool_maxsize=http_options['per_host'],
+      pool_block=True,
+      max_retries=Retry(
+        total=http_options['retries'],
+        backoff_factor=http_options['backoff'],
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+      )
+    )
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+  return http_session
+
+def http_get(url, headers=None):
+  return get_http_session().get(url, headers=headers, timeout=http_options['timeout'])
+
+def fetch_text(url):
+  response = http_get(url)
+  response.raise_for_status()
+  return response.text
+
+def parse_html(body, *selectors):
+  import bs4
+
+  # Only build a tree for the tags matching one of the tag.class selectors
+  # (and everything inside them), rather than the whole page
+  selectors = [selector.split('.') for selector in selectors]
+
+  def wanted(name, attrs):
+    classes = attrs.get('class') or []
+    if isinstance(classes, basestring):
+      classes = classes.split()
+    return any(name == tag_name and class_name in classes for tag_name, class_name in selectors)
+
+  return bs4.BeautifulSoup(body, 'html.parser', parse_only=bs4.SoupStrainer(wanted))
+
+def parse_count(value):
+  value = value.replace(',', '')
+  if value.isdigit():
+    return int(value)
+  return None
+
+def parse_text(value):
+  return value
+
+# The tables on the current cases page, in the order they appear. Each column
+# has a name and the function used to parse its cells, and the first column
+# holds the row labels.
+SUMMARY_PAGE_TABLES = [
+  ('summary', [('label', parse_text), ('total', parse_count), ('change', parse_count)]),
+  ('quarantine', [('border_total', parse_count), ('facilities_active', parse_count)]),
+  ('dhb_total', [('label', parse_text), ('active', parse_count), ('recovered', parse_count), ('deceased', parse_count), ('total', parse_count), ('change', parse_count)]),
+  ('dhb_hospitalized', [('label', parse_text), ('total', parse_count)]),
+  ('age_groups', [('label', parse_text), ('active', parse_count), ('recovered', parse_count), ('deceased', parse_count), ('total', parse_count)]),
+  ('source', [('label', parse_text), ('percentage', lambda value: parse_perc(value) if value else None)]),
+  ('testing', [('label', parse_text), ('tests', parse_count), ('date', parse_text)]),
+  ('tests_by_day', [('label', parse_text), ('tests', parse_count), ('cumulative', parse_count)]),
+]
+
+class Table(object):
+  # A parsed table, stored as a list of values per column, with an index from
+  # the first column's labels to their (first) row
+  def __init__(self, headers, names, columns):
+    self.headers = headers
+    self.names = names
+    self.columns = dict(zip(names, columns))
+    self.index = {}
+    for i, label in enumerate(columns[0]):
+      self.index.setdefault(label, i)
+
+  @classmethod
+  def from_dict(cls, data):
+    return cls(data['headers'], data['names'], data['columns'])
+
+  def to_dict(self):
+    return {
+      'headers': self.headers,
+      'names': self.names,
+      'columns': [self.columns[name] for name in self.names],
+    }
 
-    row = []
-    for d in data_cells:
-      value = d.text.strip()
+  def __len__(self):
+    return len(self.columns[self.names[0]])
+
+  def get(self, label, column):
+    return self.columns[column][self.index[label]]
+
+  def rows(self):
+    return zip(*[self.columns[name] for name in self.names])
+
+def parse_table(t, schema):
+  rows = t.find_all('tr')
+  headers = [cell.get_text().strip() for cell in rows[0].find_all(['th', 'td'], recursive=False)] if rows else []
+
+  names = [name for name, _ in schema]
+  parsers = [parser for _, parser in schema]
+  columns = [[] for _ in schema]
+  for tr in rows[1:]:
+    cells = tr.find_all(['th', 'td'], recursive=False)
+    for i, parser in enumerate(parsers):
+      columns[i].append(parser(cells[i].get_text().strip()) if i < len(cells) else None)
+
+  return Table(headers, names, columns)
+
+def parse_tables(soup, selector, schemas):
+  tables = soup.select(selector)
+  if len(tables) != len(schemas):
+    raise ValueError('Expected %d tables matching %s, found %d' % (len(schemas), selector, len(tables)))
+
+  return dict((name, parse_table(t, schema)) for t, (name, schema) in zip(tables, schemas))
+
+def get_timeseries_data_media_releases(base_url, listing_window=4, full_crawl=False, fetch_concurrency=8, revalidate_after=None, workers=1, extraction_cache_file=None, document_budget=None, pattern_budget=None, profile=None):
+  with profiled(profile, 'listing'):
+    post_list = get_media_release_list(base_url, window=listing_window, frontier_file=FRONTIER_FILE, full_crawl=full_crawl)
+
+  extraction_cache = {}
+  if extraction_cache_file is not None:
+    extraction_cache = load_extraction_cache(extraction_cache_file)
+
+  records = []
+  pending = []
+  with profiled(profile, 'fetch'):
+    for post_url, body_hash in fetch_media_releases(post_list, concurrency=fetch_concurrency, revalidate_after=revalidate_after):
+      # Releases that couldn't be fetched are left out of this run
+      if body_hash is None:
+        records.append(None)
+        continue
+      record = extraction_cache.get(body_hash)
+      if record is not None and extraction_record_is_current(record):
+        records.append(record)
+      else:
+        records.append(None)
+        pending.append((len(records) - 1, post_url, media_release_cache_filename(post_url), record))
+
+  with profiled(profile, 'extract'):
+    extracted = extract_media_releases(
+      [(post_url, cache_filename, record, pattern_budget, profile is not None) for _, post_url, cache_filename, record in pending],
+      workers,
+      document_budget
+    )
 
-      if re.match(r'^\d+$', value.replace(',', '')):
-        value = int(value.replace(',', ''))
-      row.append(value)
+  for (i, _, _, _), record in zip(pending, extracted):
+    # Releases that ran over budget are left out of this run, and retried on
+    # the next one
+    if record is None:
+      continue
+    release_profile = record.pop('profile', None)
+    if profile is not None:
+      profile['releases'].append(release_profile)
+    records[i] = record
+    extraction_cache[record['hash']] = record
+
+  if extraction_cache_file is not None and any(record is not None for record in extracted):
+    save_extraction_cache(extraction_cache_file, extraction_cache)
+
+  # Remember which extracted values make up this run, for --render-only
+  if extraction_cache_file is not None:
+    save_release_list(RELEASE_LIST_FILE, [[post_url, record['hash']] for post_url, record in zip(post_list, records) if record is not None])
+
+  return merge_media_release_records([record for record in records if record is not None])
+
+def media_release_cache_filename(post_url):
+  return 'data_cache/%s.html' % post_url.replace('/', '_')
+
+def fetch_media_releases(post_list, concurrency=8, revalidate_after=None):
+  # Yields (post_url, body hash) for each release, in order. Releases that
+  # aren't cached yet are downloaded concurrently, up to the session's
+  # per-host connection limit. Only the hashes are passed on, so no more than
+  # a few bodies are in memory at once; extraction reads them back from the
+  # cache as it gets to them.
+  #
+  # A release that can't be downloaded (once the session has run out of
+  # retries) yields None instead. It's left uncached and out of this run, and
+  # tried again on the next one.
+  import requests
+
+  def fetch(post_url):
+    try:
+      return hash_body(cache_request(
+        media_release_cache_filename(post_url),
+        lambda headers: http_get(post_url, headers=headers),
+        revalidate_after=revalidate_after
+      ))
+    except requests.RequestException as e:
+      log('Skipping %s: fetching it failed: %r' % (post_url, e))
+      return None
+
+  # Open the pack before the threads start, so they share the one copy.
+  # Anything written to it is held in memory until it's flushed, so it's
+  # flushed every so often rather than holding a whole cold crawl.
+  pack = get_cache_pack()
+  pool = multiprocessing.pool.ThreadPool(concurrency)
+  try:
+    for post_url, body_hash in itertools.izip(post_list, pool.imap(fetch, post_list)):
+      if pack is not None and len(pack.pending) >= CACHE_FLUSH_BATCH:
+        pack.flush()
+      yield post_url, body_hash
+  finally:
+    pool.close()
+    pool.join()
+    # Keep whatever did download, even if something else failed
+    flush_cache()
+
+# Most cache entries (release bodies and their .meta files) written to a pack
+# before the fetch flushes it
+CACHE_FLUSH_BATCH = 64
+
+def merge_media_release_records(records):
+  data = {}
+  results = [media_release_entry(record) for record in records]
 
-    data.append(row)
+  # sorted() is stable, so releases sharing a date are still merged in listing
+  # order
+  for date, entry in sorted([r for r in results if r is not None], key=lambda r: r[0]):
+    data[date] = entry
 
-  return (headers, data)
+  return data
 
-def get_timeseries_data_media_releases(base_url):
-  data = {}
+# Every listing item seen, as [url, listing date, passed the title filters],
+# newest first. Bump the version when changing the filters, so the next crawl
+# goes all the way back again.
+FRONTIER_FILE = 'data_cache/frontier.json'
+FRONTIER_VERSION = 1
+
+def load_frontier(frontier_file):
+  if frontier_file is None or not os.path.exists(frontier_file):
+    return None
+  with open(frontier_file, 'rb') as f:
+    frontier = json.load(f)
+  if frontier['version'] != FRONTIER_VERSION:
+    return None
+  return frontier['items']
+
+def get_media_release_list(base_url, window=4, frontier_file=None, full_crawl=False, known_run=10):
+  # With a frontier from an earlier crawl, the listing is only read until
+  # known_run posts in a row are already in it; everything older comes from
+  # the frontier. full_crawl reads the whole listing regardless.
+  frontier = load_frontier(frontier_file)
+  known = None
+  if frontier is not None and not full_crawl:
+    known = set(url for url, _, _ in frontier)
+
+  items = []
+  seen = set()
+  known_run_length = 0
+  reached_known = False
+
+  # When we expect to stop early, start with one page and only fetch further
+  # ahead once it's clear we're going further back
+  current_window = 1 if known is not None else window
+  pool = multiprocessing.pool.ThreadPool(window)
+  try:
+    pending_pages = collections.deque()
+    next_page_num = 0
+    page_num = 0
+    current_year = '2020'
+
+    # We don't care about posts from before 2020
+    while current_year == '2020' and not reached_known:
+      # Keep a window of listing pages downloading ahead of the one we're
+      # reading, so we aren't waiting on one page at a time
+      while len(pending_pages) < current_window:
+        pending_pages.append(pool.apply_async(fetch_text, (base_url + '?page=%d' % next_page_num,)))
+        next_page_num += 1
+      current_window = min(window, current_window * 2)
+
+      page = parse_html(pending_pages.popleft().get(), 'div.view-content')
+      content = page.select_one('div.view-content')
+      page_num += 1
+
+      # The listing goes back well past 2020, so a page without any posts
+      # means the site sent something broken. Carrying on would publish (and
+      # remember in the frontier) a list missing every older release.
+      items_on_page = content.select('div.item-list li') if content is not None else []
+      if not items_on_page:
+        raise ValueError('No media releases on listing page %d, before reaching the end of 2020' % (page_num - 1))
+
+      for li in items_on_page:
+        title_div = li.select_one('div.views-field-title')
+        news_type = li.select_one('div.views-field-field-news-type')
+        post_url = urlparse.urljoin(base_url, title_div.select_one('a').attrs['href'])
+        date = li.select_one('span.date-display-single').attrs['content']
+
+        included = ('COVID-19' in title_div.text or 'new cases' in title_div.text) and news_type.text.strip() == 'Media release' and 'Point of Care Test Kits' not in title_div.text and 'no live media update' not in title_div.text and 'testing system' not in title_div.text
+        if post_url not in seen:
+          items.append([post_url, date, included])
+          seen.add(post_url)
+
+        current_year = date.split('-')[0]
+
+        if known is not None:
+          known_run_length = known_run_length + 1 if post_url in known else 0
+          if known_run_length >= known_run:
+            reached_known = True
+            break
+  finally:
+    # Any pages fetched past the end of 2020 are just dropped
+    pool.close()
+    pool.join()
+
+  if reached_known:
+    items.extend(item for item in frontier if item[0] not in seen)
+
+  if frontier_file is not None:
+    write_if_changed(frontier_file, json.dumps({'version': FRONTIER_VERSION, 'items': items}, sort_keys=True))
+
+  return [post_url for post_url, _, included in items if included]
+
+RELEASE_REGEXES = {
+  'recovered': [
+    r'.*There are (?:now )?(?P<recovered>[\d,]+) (?:(?:reported cases)|(?:individuals)|(?:cases)|(?:people)|(?:people reported as)) (?:(?:of COVID-19 )?(?:with COVID-19 )?(?:infection )?(?:(?:(?:which )?(?:that )?we can confirm)|who) )?(?:have|are|having) recovered.*',
+    r'.*total number of people who have recovered to (?P<recovered>[\d,]+)[^\d,].*',
+    r'.*(?:(?:our cases,)|with|are|have) (?P<recovered>[\d,]+) (?:people )?(?:cases )?(?:that )?(?:are )?reported as (?:having )?recovered.*',
+    r'.*We have (?P<recovered>[\d,]+) people who have recovered from COVID-19.*',
+    r'.*as having recovered from COVID-19, an increase of \w+ on yesterday, for a total of (?P<recovered>[\d,]+)\..*',
+    r'.*no change to the number of (?:people )?recovered (?:cases which remain )?at (?P<recovered>[\d,]+)[\. ].*',
+    r'.*taking recoveries to (?P<recovered>[\d,]+)\..*',
+    r'.*we can report \w+ new recovered cases taking the total to (?P<recovered>[\d,]+)\..*',
+    r'.*recovered case(?:s)?(?: meaning this total)? is now (?P<recovered>[\d,]+)\..*',
+    r'.*recovered cases is (?:unchanged at )?(?P<recovered>[\d,]+)\..*',
+    r'.*recovered cases remains at (?P<recovered>[\d,]+)\..*',
+  ],
+  'confirmed': [
+    r'.*This means the current national total is (?P<confirmed>[\d,]+)[,\.].*',
+    # The [^W][^\'][^'s] here is a silly hack to work around a single day where NZ
+    # Health said "NSW's total number of cases is..."
+    r'.*[^W][^\'][^s] total (?:number )?of (?:confirmed and probable )?(?:COVID-19 )?cases (?:in New Zealand )?(is|to) (?:now )?(?:a total of )?(?P<confirmed>[\d,]+)[^\d,].*',
+    r'.*total number of COVID-19 cases in New Zealand, which remains at (?P<confirmed>[\d,]+)[^\d,].*',
+    r'.*total of confirmed and probable cases[^.]+ (to|at) (?P<confirmed>[\d,]+)[^\d,].*',
+  ],
+  'deaths': [
+    r'.*the total of deaths in New Zealand to (?P<deaths>\d+)[^\d].*',
+    r'.*New Zealand now has (?P<deaths>[^ ]+) (?:COVID-19 related )?deaths(?: associated with COVID-19)?.*',
+    r'.*to report (a|(the country.s)) (?P<deaths>[^ ]+) death linked to COVID-19.*',
+    r'.*There have now been (?P<deaths>[^ ]+) deaths from COVID-19.*',
+    r'.*total number of confirmed COVID-19 deaths in New Zealand to (?P<deaths>[^.]+).*',
+    r'.*we have one additional death to report today which takes our total to (?P<deaths>[^.]+).*',
+    r'.*This is our (?P<deaths>[^ ]+) death from COVID-19.*'
+  ],
+  'hospitalized': [
+    r'.*(?:(?:[Tt]here are)|(?:we have)|(?:can report)) (?P<hospitalized>[^ ]+) (?:people )?in hospital.*(((That|(The total)|(That total)) includes)|including) (?P<icu>[^ ]+) (?:people )?(?:person )?(?:in [^ ]+ )?in (?:the )?ICU[ \.].*',
+    r'.*(?:(?:[Tt]here are)|(?:[Ww]e have)|(?:can report)) (?P<hospitalized>[^ ]+) people (?:remain )?in hospital(?: with COVID-19)?.*',
+  ],
+  'icu': [
+    r'.*(?:(?:[Tt]here are)|(?:we have)|(?:can report)) (?P<hospitalized>[^ ]+) (?:people )?in hospital.*(((That|(The total)|(That total)) includes)|including) (?P<icu>[^ ]+) (?:people )?(?:person )?(?:in [^ ]+ )?in (?:the )?ICU[ \.].*',
+    r'.*(?P<icu>([Nn]either)|([Nn]one)) (?:are )?in ICU.*'
+  ],
+  'tests': [
+    r'.*total (?:(?:number of cases carried out)|(?:tests)|(?:(?:number )?of (lab )?tests)) (?:undertaken )?(?:completed )?to date (to|of|is|are) (?P<tests>[\d,]+)[^\d].*',
+    r'.*[^\d,](?P<tests>[\d,]+) (?:total )?tests (?:have been )?processed to date\..*',
+    r'.*tests completed(?: yesterday,)? (with|for) a combined total to date of (?P<tests>[\d,]+)\..*',
+  ]
+}
+
+SOURCE_REGEXES = [
+  r'.* to overseas travel \((?P<overseas>\d+)\%\).*links to confirmed cases within New Zealand \((?P<within_nz>\d+)\%\).*community transmission \((?P<community>\d+)\%\).*(?:still investigating (?P<investigation>\d+)\%)?.*',
+  r'.* (?P<epi_link>\d+)\% involve contact with a confirmed case within New Zealand.*(?P<overseas>\d+)\% have a link with overseas travel.*community transmission accounts for (?P<community>\d+)\%.*still investigating (?P<investigation>\d+)\% of cases.*',
+]
+
+# Bump this when the code turning matches into values changes, so that every
+# cached extraction is redone
+EXTRACTION_VERSION = 1
+
+EXTRACTION_CACHE_FILE = 'data_cache/extracted.jsonl'
+
+def regex_table_version(patterns):
+  return hashlib.sha1(json.dumps([EXTRACTION_VERSION, patterns])).hexdigest()[:16]
+
+# Each group is versioned separately, so editing one entry of RELEASE_REGEXES
+# only invalidates the cached values for that group
+RELEASE_REGEX_VERSIONS = dict((group_name, regex_table_version(regex_list)) for group_name, regex_list in RELEASE_REGEXES.iteritems())
+SOURCE_REGEX_VERSION = regex_table_version(SOURCE_REGEXES)
+
+# Every pattern in a group contains its keyword verbatim, so a group can only
+# match a release that mentions the keyword somewhere in its body
+RELEASE_REGEX_KEYWORDS = {
+  'recovered': 'recover',
+  'confirmed': 'total',
+  'deaths': 'death',
+  'hospitalized': 'in hospital',
+  'icu': 'ICU',
+  'tests': 'to date',
+}
+SOURCE_REGEX_KEYWORD = 'community transmission'
+
+def compile_release_regex(r):
+  # The patterns are written as .*<pattern>.* for re.match against the whole
+  # body. Searching for just the middle avoids re-scanning the body from the
+  # end for every pattern.
+  if r.startswith('.*'):
+    r = r[2:]
+  if r.endswith('.*') and not r.endswith('\\.*'):
+    r = r[:-2]
+  return re.compile(r, re.MULTILINE | re.DOTALL)
+
+COMPILED_RELEASE_REGEXES = dict((group_name, [compile_release_regex(r) for r in regex_list]) for group_name, regex_list in RELEASE_REGEXES.iteritems())
+COMPILED_SOURCE_REGEXES = [compile_release_regex(r) for r in SOURCE_REGEXES]
+RELEASE_KEYWORD_REGEX = re.compile('(?=(%s))' % '|'.join(re.escape(k) for k in sorted(set(RELEASE_REGEX_KEYWORDS.values() + [SOURCE_REGEX_KEYWORD]))))
+
+def find_release_keywords(content):
+  return set(RELEASE_KEYWORD_REGEX.findall(content))
+
+def search_last(pattern, content):
+  # With a greedy leading .*, re.match picks the match that starts furthest into
+  # the body, so keep searching past each match until there are no more
+  last_match = None
+  m = pattern.search(content)
+  while m:
+    last_match = m
+    m = pattern.search(content, m.start() + 1)
+  return last_match
+
+def hash_body(body):
+  if isinstance(body, unicode):
+    body = body.encode('utf-8')
+  return hashlib.sha1(body).hexdigest()
+
+# Loaded caches stay in memory, so a long running process only reads each
+# file once
+loaded_extraction_caches = {}
+
+def load_extraction_cache(cache_filename, key='hash'):
+  if cache_filename in loaded_extraction_caches:
+    return loaded_extraction_caches[cache_filename]
+
+  extraction_cache = loaded_extraction_caches[cache_filename] = {}
+  if not os.path.exists(cache_filename):
+    return extraction_cache
+
+  with open(cache_filename, 'rb') as f:
+    for line in f:
+      if line.strip():
+        record = json.loads(line)
+        extraction_cache[record[key]] = record
+
+  return extraction_cache
+
+def save_extraction_cache(cache_filename, extraction_cache):
+  make_parent_dir(cache_filename)
+  tmp_filename = cache_filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    for record in sorted(extraction_cache.values(), key=lambda r: (r['date'], r['hash'])):
+      f.write(json.dumps(record, sort_keys=True) + '\n')
+  os.rename(tmp_filename, cache_filename)
+
+RELEASE_LIST_FILE = 'data_cache/releases.json'
+
+def save_release_list(filename, release_list):
+  write_if_changed(filename, json.dumps(release_list, indent=0))
+
+def new_profile():
+  return {
+    'stages': {},
+    'peak_rss_mb': {},
+    'releases': [],
+    # Peak RSS so far of each stage that's still running, innermost last
+    'running_peaks': [],
+  }
 
-  post_list = []
+def reset_peak_rss():
+  # This process's peak RSS only ever goes up, which on its own would give
+  # every stage the peak of the biggest one before it. Linux lets it be reset
+  # (by writing 5 to clear_refs); elsewhere only the workers' peak is given.
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except IOError:
+    return False
+
+def read_peak_rss_mb():
+  # The peak RSS since it was last reset, in MB
+  with open('/proc/self/status') as f:
+    return int(re.search(r'VmHWM:\s+(\d+) kB', f.read()).group(1)) / 1024.0
+
+@contextlib.contextmanager
+def profiled(profile, stage):
+  if profile is None:
+    yield
+    return
+
+  # Stages nest, so the peak so far is handed on to the enclosing stage
+  # before being reset for this one. None means the peak can't be measured.
+  running_peaks = profile['running_peaks']
+  if running_peaks and running_peaks[-1] is not None:
+    running_peaks[-1] = max(running_peaks[-1], read_peak_rss_mb())
+  running_peaks.append(0 if reset_peak_rss() else None)
+  start_time = time.time()
+  try:
+    yield
+  finally:
+    profile['stages'][stage] = time.time() - start_time
+    peak = running_peaks.pop()
+    if peak is not None:
+      peak = max(peak, read_peak_rss_mb())
+      if running_peaks and running_peaks[-1] is not None:
+        running_peaks[-1] = max(running_peaks[-1], peak)
+    profile['peak_rss_mb'][stage] = {
+      'self': peak,
+      # Worker processes can't be reset, so this is the largest extraction
+      # worker of the whole run so far. ru_maxrss is in kilobytes on Linux.
+      'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    }
 
-  page_num = 0
-  current_year = '2020'
+def write_profile_report(filename, profile):
+  patterns = {}
+  for group_name, regex_list in RELEASE_REGEXES.items() + [('sources', SOURCE_REGEXES)]:
+    patterns[group_name] = [{'index': i, 'pattern': r, 'calls': 0, 'matches': 0, 'seconds': 0.0} for i, r in enumerate(regex_list)]
+
+  unmatched = dict((group_name, []) for group_name in patterns)
+  releases = []
+  for release in profile['releases']:
+    for group_name, stats in release['patterns'].iteritems():
+      for pattern_index, seconds, matched in stats:
+        pattern = patterns[group_name][pattern_index]
+        pattern['calls'] += 1
+        pattern['seconds'] += seconds
+        if matched:
+          pattern['matches'] += 1
+
+    # Releases after the cutoff aren't matched against, so never show up here
+    for group_name, pattern_index in release['matched'].iteritems():
+      if pattern_index is None:
+        unmatched[group_name].append(release['url'])
+
+    releases.append({
+      'url': release['url'],
+      'date': release['date'],
+      'seconds': release['seconds'],
+      'parse_seconds': release['parse_seconds'],
+      'pattern_seconds': sum(seconds for stats in release['patterns'].values() for _, seconds, _ in stats),
+      'matched': release['matched'],
+    })
+
+  report = {
+    'stages': profile['stages'],
+    'peak_rss_mb': profile['peak_rss_mb'],
+    'releases': sorted(releases, key=lambda r: r['seconds'], reverse=True),
+    'patterns': patterns,
+    'unmatched': dict((group_name, sorted(urls)) for group_name, urls in unmatched.iteritems()),
+  }
 
-  # We don't care about posts from before 2020
-  while current_year == '2020':
-    page = bs4.BeautifulSoup(requests.get(base_url + '?page=%d' % page_num).text, 'html.parser')
-    content = page.select_one('div.view-content')
+  with open(filename, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+
+def log(message):
+  sys.stderr.write(message + '\n')
+
+def media_release_is_current(date_string):
+  # After this date, we pull from new data
+  return datetime.datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%S') <= datetime.datetime(2020, 6, 20)
+
+def extraction_record_is_current(record):
+  if not media_release_is_current(record['date']):
+    return True
+
+  for group_name, version in RELEASE_REGEX_VERSIONS.iteritems():
+    if record['fields'].get(group_name, [None])[0] != version:
+      return False
+
+  return record['sources'][0] == SOURCE_REGEX_VERSION
+
+def extract_media_releases(pending_args, workers, document_budget):
+  # Parsing is CPU-bound, so spread the releases over a pool of worker
+  # processes
+  if document_budget is None and workers <= 1:
+    return [extract_media_release(args) for args in pending_args]
+
+  # A pathological regex can't be interrupted from within the process running
+  # it, so with a budget the work always happens in a pool that we can tear
+  # down. Whatever was still queued behind a release that overran is retried
+  # in a fresh pool.
+  workers = max(workers, 1)
+  extracted = [None] * len(pending_args)
+  remaining = range(len(pending_args))
+  while remaining:
+    pool = multiprocessing.Pool(workers)
+    queued = collections.deque(remaining)
+    in_flight = collections.deque()
+    remaining = []
+    timed_out = False
+
+    try:
+      while in_flight or (queued and not timed_out):
+        # Only hand the pool a few releases at a time. Python 2's
+        # Pool.terminate() can hang if its task queue is still full.
+        while queued and not timed_out and len(in_flight) < 2 * workers:
+          i = queued.popleft()
+          in_flight.append((i, pool.apply_async(extract_media_release, (pending_args[i],))))
+
+        i, async_result = in_flight.popleft()
+        if timed_out:
+          if async_result.ready():
+            extracted[i] = async_result.get()
+          else:
+            remaining.append(i)
+          continue
+
+        try:
+          extracted[i] = async_result.get(document_budget)
+        except multiprocessing.TimeoutError:
+          log('Skipping %s: extraction took longer than %ss' % (pending_args[i][0], document_budget))
+          timed_out = True
+    except:
+      pool.terminate()
+      raise
+
+    remaining.extend(queued)
+    if timed_out:
+      pool.terminate()
+    else:
+      pool.close()
+    pool.join()
 
-    for li in content.select('div.item-list li'):
-      title_div = li.select_one('div.views-field-title')
-      news_type = li.select_one('div.views-field-field-news-type')
+  return extracted
 
-      if ('COVID-19' in title_div.text or 'new cases' in title_div.text) and news_type.text.strip() == 'Media release' and 'Point of Care Test Kits' not in title_div.text and 'no live media update' not in title_div.text and 'testing system' not in title_div.text:
-        post_list.append('https://www.health.govt.nz%s' % title_div.select_one('a').attrs['href'])
+def extract_media_release(args):
+  post_url, cache_filename, record, pattern_budget, profile = args
+  start_time = time.time()
 
-      current_year = li.select_one('span.date-display-single').attrs['content'].split('-')[0]
+  response_body = cache_read(cache_filename)
 
-    page_num += 1
+  date_string, content = parse_media_release(response_body)
+  parse_time = time.time() - start_time
 
-  for post_url in post_list:
-    response_body = cache_request(
-      'data_cache/%s.html' % post_url.replace('/', '_'),
-      lambda: requests.get(post_url).text
-    )
+  release_profile = None
+  if profile:
+    release_profile = {
+      'url': post_url,
+      'date': date_string,
+      'parse_seconds': parse_time,
+      'patterns': {},
+      'matched': {},
+    }
 
-    soup = bs4.BeautifulSoup(response_body, 'html.parser')
-    date_string = soup.select_one('span.date-display-single').attrs['content'].split('+')[0]
-    date = datetime.datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%S')
+  record = extract_release_record(hash_body(response_body), date_string, content, record, post_url=post_url, pattern_budget=pattern_budget, profile=release_profile)
 
-    # After this date, we pull from new data
-    if date > datetime.datetime(2020, 6, 20):
-      continue
+  if release_profile is not None:
+    release_profile['seconds'] = time.time() - start_time
+    record['profile'] = release_profile
+
+  return record
 
+def parse_media_release(response_body):
+  soup = parse_html(response_body, 'span.date-display-single', 'div.field-name-body')
+  date_string = soup.select_one('span.date-display-single').attrs['content'].split('+')[0]
+
+  # The body is only needed for releases we still pull data from
+  content = None
+  if media_release_is_current(date_string):
     content = soup.select_one('div.field-name-body').text
 
-    tmp_data = {}
-    overseas = None
-    community = None
-    epi_link = None
-    investigation = None
-
-    regexes = {
-      'recovered': [
-        r'.*There are (?:now )?(?P<recovered>[\d,]+) (?:(?:reported cases)|(?:individuals)|(?:cases)|(?:people)|(?:people reported as)) (?:(?:of COVID-19 )?(?:with COVID-19 )?(?:infection )?(?:(?:(?:which )?(?:that )?we can confirm)|who) )?(?:have|are|having) recovered.*',
-        r'.*total number of people who have recovered to (?P<recovered>[\d,]+)[^\d,].*',
-        r'.*(?:(?:our cases,)|with|are|have) (?P<recovered>[\d,]+) (?:people )?(?:cases )?(?:that )?(?:are )?reported as (?:having )?recovered.*',
-        r'.*We have (?P<recovered>[\d,]+) people who have recovered from COVID-19.*',
-        r'.*as having recovered from COVID-19, an increase of \w+ on yesterday, for a total of (?P<recovered>[\d,]+)\..*',
-        r'.*no change to the number of (?:people )?recovered (?:cases which remain )?at (?P<recovered>[\d,]+)[\. ].*',
-        r'.*taking recoveries to (?P<recovered>[\d,]+)\..*',
-        r'.*we can report \w+ new recovered cases taking the total to (?P<recovered>[\d,]+)\..*',
-        r'.*recovered case(?:s)?(?: meaning this total)? is now (?P<recovered>[\d,]+)\..*',
-        r'.*recovered cases is (?:unchanged at )?(?P<recovered>[\d,]+)\..*',
-        r'.*recovered cases remains at (?P<recovered>[\d,]+)\..*',
-      ],
-      'confirmed': [
-        r'.*This means the current national total is (?P<confirmed>[\d,]+)[,\.].*',
-        # The [^W][^\'][^'s] here is a silly hack to work around a single day where NZ
-        # Health said "NSW's total number of cases is..."
-        r'.*[^W][^\'][^s] total (?:number )?of (?:confirmed and probable )?(?:COVID-19 )?cases (?:in New Zealand )?(is|to) (?:now )?(?:a total of )?(?P<confirmed>[\d,]+)[^\d,].*',
-        r'.*total number of COVID-19 cases in New Zealand, which remains at (?P<confirmed>[\d,]+)[^\d,].*',
-        r'.*total of confirmed and probable cases[^.]+ (to|at) (?P<confirmed>[\d,]+)[^\d,].*',
-      ],
-      'deaths': [
-        r'.*the total of deaths in New Zealand to (?P<deaths>\d+)[^\d].*',
-        r'.*New Zealand now has (?P<deaths>[^ ]+) (?:COVID-19 related )?deaths(?: associated with COVID-19)?.*',
-        r'.*to report (a|(the country.s)) (?P<deaths>[^ ]+) death linked to COVID-19.*',
-        r'.*There have now been (?P<deaths>[^ ]+) deaths from COVID-19.*',
-        r'.*total number of confirmed COVID-19 deaths in New Zealand to (?P<deaths>[^.]+).*',
-        r'.*we have one additional death to report today which takes our total to (?P<deaths>[^.]+).*',
-        r'.*This is our (?P<deaths>[^ ]+) death from COVID-19.*'
-      ],
-      'hospitalized': [
-        r'.*(?:(?:[Tt]here are)|(?:we have)|(?:can report)) (?P<hospitalized>[^ ]+) (?:people )?in hospital.*(((That|(The total)|(That total)) includes)|including) (?P<icu>[^ ]+) (?:people )?(?:person )?(?:in [^ ]+ )?in (?:the )?ICU[ \.].*',
-        r'.*(?:(?:[Tt]here are)|(?:[Ww]e have)|(?:can report)) (?P<hospitalized>[^ ]+) people (?:remain )?in hospital(?: with COVID-19)?.*',
-      ],
-      'icu': [
-        r'.*(?:(?:[Tt]here are)|(?:we have)|(?:can report)) (?P<hospitalized>[^ ]+) (?:people )?in hospital.*(((That|(The total)|(That total)) includes)|including) (?P<icu>[^ ]+) (?:people )?(?:person )?(?:in [^ ]+ )?in (?:the )?ICU[ \.].*',
-        r'.*(?P<icu>([Nn]either)|([Nn]one)) (?:are )?in ICU.*'
-      ],
-      'tests': [
-        r'.*total (?:(?:number of cases carried out)|(?:tests)|(?:(?:number )?of (lab )?tests)) (?:undertaken )?(?:completed )?to date (to|of|is|are) (?P<tests>[\d,]+)[^\d].*',
-        r'.*[^\d,](?P<tests>[\d,]+) (?:total )?tests (?:have been )?processed to date\..*',
-        r'.*tests completed(?: yesterday,)? (with|for) a combined total to date of (?P<tests>[\d,]+)\..*',
-      ]
-    }
+  return date_string, content
+
+def extract_release_record(body_hash, date_string, content, record, post_url=None, pattern_budget=None, profile=None):
+  # Only keep what's still valid from a previous extraction of the same body
+  old_fields = {}
+  old_sources = [None, None]
+  if record is not None and record['date'] == date_string:
+    old_fields = record['fields']
+    old_sources = record['sources']
+
+  record = {
+    'hash': body_hash,
+    'date': date_string,
+    'fields': {},
+    'sources': [None, None],
+  }
 
-    for group_name, regex_list in regexes.iteritems():
-      for r in regex_list:
-        m = re.match(r, content, re.MULTILINE | re.DOTALL)
-        if m:
-          matched = m.group(group_name)
+  if not media_release_is_current(date_string):
+    return record
 
-          if matched.lower() in ['neither', 'none']:
-            tmp_data[group_name] = 0
-          elif matched.endswith('th') or matched in ['first', 'second', 'third']:
-            tmp_data[group_name] = parse_ordinal(matched)
-          else:
-            tmp_data[group_name] = parse_num(matched)
+  keywords = find_release_keywords(content)
+
+  for group_name, version in RELEASE_REGEX_VERSIONS.iteritems():
+    if old_fields.get(group_name, [None])[0] == version:
+      record['fields'][group_name] = old_fields[group_name]
+      continue
+
+    pattern_stats = None
+    if profile is not None:
+      pattern_stats = profile['patterns'][group_name] = []
+
+    value = extract_release_field(group_name, content, keywords, post_url=post_url, pattern_budget=pattern_budget, pattern_stats=pattern_stats)
+    record['fields'][group_name] = [version, value]
+
+  if old_sources[0] == SOURCE_REGEX_VERSION:
+    record['sources'] = old_sources
+  else:
+    pattern_stats = None
+    if profile is not None:
+      pattern_stats = profile['patterns']['sources'] = []
+
+    record['sources'] = [SOURCE_REGEX_VERSION, extract_source_percentages(content, keywords, pattern_stats=pattern_stats)]
+
+  if profile is not None:
+    for group_name, stats in profile['patterns'].iteritems():
+      matched = [pattern_index for pattern_index, _, m in stats if m]
+      profile['matched'][group_name] = matched[0] if matched else None
+
+  return record
+
+def extract_release_field(group_name, content, keywords, post_url=None, pattern_budget=None, pattern_stats=None):
+  if RELEASE_REGEX_KEYWORDS[group_name] not in keywords:
+    return None
 
-          break
+  for pattern_index, r in enumerate(COMPILED_RELEASE_REGEXES[group_name]):
+    pattern_start_time = time.time()
+    m = search_last(r, content)
+    pattern_time = time.time() - pattern_start_time
+    if pattern_budget is not None and pattern_time > pattern_budget:
+      log('Slow pattern %s[%d] on %s: %.1fs' % (group_name, pattern_index, post_url, pattern_time))
+    if pattern_stats is not None:
+      pattern_stats.append([pattern_index, pattern_time, m is not None])
 
-    m = re.match(r'.* to overseas travel \((?P<overseas>\d+)\%\).*links to confirmed cases within New Zealand \((?P<within_nz>\d+)\%\).*community transmission \((?P<community>\d+)\%\).*(?:still investigating (?P<investigation>\d+)\%)?.*', content, re.MULTILINE | re.DOTALL)
     if m:
-      overseas_perc = parse_perc(m.group('overseas'))
-      within_nz_perc = parse_perc(m.group('within_nz'))
-      community_perc = parse_perc(m.group('community'))
-      if m.group('investigation'):
-        investigation_perc = parse_perc(m.group('investigation'))
+      matched = m.group(group_name)
+
+      if matched.lower() in ['neither', 'none']:
+        return 0
+      elif matched.endswith('th') or matched in ['first', 'second', 'third']:
+        return parse_ordinal(matched)
       else:
-        investigation_perc = None
+        return parse_num(matched)
+
+  return None
+
+def extract_source_percentages(content, keywords, pattern_stats=None):
+  if SOURCE_REGEX_KEYWORD not in keywords:
+    return None
 
-      overseas = int(round(tmp_data['confirmed'] * overseas_perc))
-      community = int(round(tmp_data['confirmed'] * community_perc))
-      epi_link = int(round(tmp_data['confirmed'] * (within_nz_perc - community_perc)))
-      if investigation_perc is not None:
-        investigation = int(round(tmp_data['confirmed'] * investigation_perc))
+  m = search_source_regex(0, content, pattern_stats)
+  if m:
+    overseas_perc = parse_perc(m.group('overseas'))
+    within_nz_perc = parse_perc(m.group('within_nz'))
+    community_perc = parse_perc(m.group('community'))
+    if m.group('investigation'):
+      investigation_perc = parse_perc(m.group('investigation'))
     else:
-      m = re.match(r'.* (?P<epi_link>\d+)\% involve contact with a confirmed case within New Zealand.*(?P<overseas>\d+)\% have a link with overseas travel.*community transmission accounts for (?P<community>\d+)\%.*still investigating (?P<investigation>\d+)\% of cases.*', content, re.MULTILINE | re.DOTALL)
-      if m:
-        overseas_perc = parse_perc(m.group('overseas'))
-        epi_link_perc = parse_perc(m.group('epi_link'))
-        community_perc = parse_perc(m.group('community'))
-        investigation_perc = parse_perc(m.group('investigation'))
-
-        overseas = int(round(tmp_data['confirmed'] * overseas_perc))
-        community = int(round(tmp_data['confirmed'] * community_perc))
-        epi_link = int(round(tmp_data['confirmed'] * epi_link_perc))
-        investigation = int(round(tmp_data['confirmed'] * investigation_perc))
-
-    if 'confirmed' in tmp_data:
-      data[date.strftime('%Y-%m-%d')] = {
-        'confirmed': tmp_data['confirmed'],
-      }
+      investigation_perc = None
+
+    return {
+      'overseas': overseas_perc,
+      'epi_link': within_nz_perc - community_perc,
+      'community': community_perc,
+      'investigation': investigation_perc,
+    }
 
-      if 'recovered' in tmp_data:
-        data[date.strftime('%Y-%m-%d')]['recovered'] = tmp_data['recovered']
+  m = search_source_regex(1, content, pattern_stats)
+  if m:
+    return {
+      'overseas': parse_perc(m.group('overseas')),
+      'epi_link': parse_perc(m.group('epi_link')),
+      'community': parse_perc(m.group('community')),
+      'investigation': parse_perc(m.group('investigation')),
+    }
 
-      if 'deaths' in tmp_data:
-        data[date.strftime('%Y-%m-%d')]['deaths'] = tmp_data['deaths']
+  return None
+
+def search_source_regex(pattern_index, content, pattern_stats):
+  pattern_start_time = time.time()
+  m = search_last(COMPILED_SOURCE_REGEXES[pattern_index], content)
+  if pattern_stats is not None:
+    pattern_stats.append([pattern_index, time.time() - pattern_start_time, m is not None])
+  return m
+
+def media_release_entry(record):
+  if not media_release_is_current(record['date']):
+    return None
+
+  tmp_data = {}
+  for group_name, (_, value) in record['fields'].iteritems():
+    if value is not None:
+      tmp_data[group_name] = value
+
+  if 'confirmed' not in tmp_data:
+    return None
+
+  overseas = None
+  community = None
+  epi_link = None
+  investigation = None
+
+  source_percentages = record['sources'][1]
+  if source_percentages is not None:
+    overseas = int(round(tmp_data['confirmed'] * source_percentages['overseas']))
+    community = int(round(tmp_data['confirmed'] * source_percentages['community']))
+    epi_link = int(round(tmp_data['confirmed'] * source_percentages['epi_link']))
+    if source_percentages['investigation'] is not None:
+      investigation = int(round(tmp_data['confirmed'] * source_percentages['investigation']))
+
+  entry = {
+    'confirmed': tmp_data['confirmed'],
+  }
 
-      if 'hospitalized' in tmp_data:
-        data[date.strftime('%Y-%m-%d')]['hospitalized'] = tmp_data['hospitalized']
+  if 'recovered' in tmp_data:
+    entry['recovered'] = tmp_data['recovered']
 
-      if 'icu' in tmp_data:
-        data[date.strftime('%Y-%m-%d')]['icu'] = tmp_data['icu']
+  if 'deaths' in tmp_data:
+    entry['deaths'] = tmp_data['deaths']
 
-      if 'tests' in tmp_data:
-        data[date.strftime('%Y-%m-%d')]['tested'] = tmp_data['tests']
+  if 'hospitalized' in tmp_data:
+    entry['hospitalized'] = tmp_data['hospitalized']
 
-      data[date.strftime('%Y-%m-%d')]['sources'] = {
-        'Overseas acquired': overseas,
-        'Locally acquired - contact of a confirmed case': epi_link,
-        'Locally acquired - contact not identified': community,
-        'Under investigation': investigation,
-      }
+  if 'icu' in tmp_data:
+    entry['icu'] = tmp_data['icu']
 
-  return data
+  if 'tests' in tmp_data:
+    entry['tested'] = tmp_data['tests']
+
+  entry['sources'] = {
+    'Overseas acquired': overseas,
+    'Locally acquired - contact of a confirmed case': epi_link,
+    'Locally acquired - contact not identified': community,
+    'Under investigation': investigation,
+  }
+
+  date = datetime.datetime.strptime(record['date'], '%Y-%m-%dT%H:%M:%S')
+  return (date.strftime('%Y-%m-%d'), entry)
 
 def add_manual_data(timeseries_data):
   events = {
@@ -528,47 +1580,33 @@ def add_manual_data(timeseries_data):
     },
   }
 
-  confirmed = 0
-  deaths = 0
-  recovered = 0
-  sources = collections.defaultdict(lambda: 0)
-
-  for date in sorted(events.keys()):
-    event_data = events[date]
-
-    if date not in timeseries_data:
-      timeseries_data[date] = {}
-
-    if 'confirmed' in event_data:
-      confirmed += event_data['confirmed']
-    timeseries_data[date]['confirmed'] = timeseries_data[date].get('confirmed', confirmed)
-
-    if 'deaths' in event_data:
-      deaths += event_data['deaths']
-    timeseries_data[date]['deaths'] = timeseries_data[date].get('deaths', deaths)
-
-    if 'recovered' in event_data:
-      recovered += event_data['recovered']
-    timeseries_data[date]['recovered'] = timeseries_data[date].get('recovered', recovered)
-
-    if 'hospitalized' in event_data:
-      timeseries_data[date]['hospitalized'] = timeseries_data[date].get('hospitalized', event_data['hospitalized'])
-    else:
-      timeseries_data[date]['hospitalized'] = timeseries_data[date].get('hospitalized', 0)
-
-    if 'icu' in event_data:
-      timeseries_data[date]['icu'] = timeseries_data[date].get('icu', event_data['icu'])
-    else:
-      timeseries_data[date]['icu'] = timeseries_data[date].get('icu', 0)
-
-    if 'tested' in event_data:
-      timeseries_data[date]['tested'] = timeseries_data[date].get('tested', event_data['tested'])
-
-    for k, v in event_data.get('sources', {}).iteritems():
-      sources[k] += v
-
-    if 'sources' not in timeseries_data[date]:
-      timeseries_data[date]['sources'] = copy.deepcopy(sources)
+  dates = sorted(events.keys())
+  timeseries_data.extend(dates[0], dates[-1])
+  offsets = [timeseries_data.offset(d) for d in dates]
+
+  # Cases, deaths and recoveries are running totals over the events, and only
+  # fill in days that don't have their own numbers
+  for k in ('confirmed', 'deaths', 'recovered'):
+    timeseries_data.fill_missing(k, offsets, cumulative_sum([events[d].get(k, 0) for d in dates]))
+
+  for k in ('hospitalized', 'icu'):
+    timeseries_data.fill_missing(k, offsets, [events[d].get(k, 0) for d in dates])
+
+  tested = [(i, events[d]['tested']) for i, d in zip(offsets, dates) if 'tested' in events[d]]
+  timeseries_data.fill_missing('tested', [i for i, _ in tested], [v for _, v in tested])
+
+  # Sources are running totals too, from the first event that mentions them,
+  # but only for days without a breakdown of their own
+  source_days = [j for j, i in enumerate(offsets) if not timeseries_data.has('sources', i)]
+  source_names = set(k for d in dates for k in events[d].get('sources', {}))
+  for k in source_names:
+    first = min(j for j, d in enumerate(dates) if k in events[d].get('sources', {}))
+    totals = cumulative_sum([events[d].get('sources', {}).get(k, 0) for d in dates])
+    for j in source_days:
+      if j >= first:
+        timeseries_data.set('sources/' + k, offsets[j], totals[j])
+  for j in source_days:
+    timeseries_data.set('sources', offsets[j], 0)
 
   absolute_overrides = {
     # https://www.health.govt.nz/news-media/media-releases/8-new-cases-covid-19
@@ -607,29 +1645,13 @@ def add_manual_data(timeseries_data):
 
   for date, data in absolute_overrides.iteritems():
     for k, v in data.iteritems():
-      timeseries_data[date][k] = v
+      timeseries_data.set(k, timeseries_data.offset(date), v)
 
   return timeseries_data
 
 def fill_in_blanks(timeseries_data):
-  deaths = 0
-  hospitalized = 0
-  icu = 0
-  for date in sorted(timeseries_data.keys()):
-    if timeseries_data[date].get('deaths', None) is None:
-      timeseries_data[date]['deaths'] = deaths
-    else:
-      deaths = timeseries_data[date]['deaths']
-
-    if timeseries_data[date].get('hospitalized', None) is None:
-      timeseries_data[date]['hospitalized'] = hospitalized
-    else:
-      hospitalized = timeseries_data[date]['hospitalized']
-
-    if timeseries_data[date].get('icu', None) is None:
-      timeseries_data[date]['icu'] = icu
-    else:
-      icu = timeseries_data[date]['icu']
+  for k in ('deaths', 'hospitalized', 'icu'):
+    timeseries_data.forward_fill(k, 0)
 
   return timeseries_data
 
@@ -638,6 +1660,7 @@ def parse_num(num):
   if re.match(r'^[\d,]+$', num):
     return int(num.replace(',', ''))
   else:
+    from word2number import w2n
     return w2n.word_to_num(num)
 
 def parse_perc(perc):
@@ -656,38 +1679,515 @@ def parse_ordinal(ordinal):
   return parse_num(ordinal)
 
 def munge_data_to_output(timeseries_data, dates, data_key):
-  dates = sorted(timeseries_data.keys())
-  values = [timeseries_data[d] for d in dates]
-
-  # Generate a list of all keys for the given data series
-  # There's probably a way to do this with a Python one liner, but I think this
-  # is clearer
-  keyset = set()
-  for v in values:
-    for k in v.get(data_key, {}).keys():
-      keyset.add(k)
-  keys = sorted(keyset)
+  # Days without a value for one of the sub-series count as 0
+  keys = timeseries_data.subseries_names(data_key)
 
   munged_data = {}
   for k in keys:
-    munged_data[k] = []
-    for d in dates:
-      munged_data[k].append(timeseries_data[d].get(data_key, {}).get(k, 0))
+    munged_data[k] = timeseries_data.series(data_key + '/' + k, missing=0)
 
   return {
     'keys': keys,
     'subseries': munged_data,
   }
 
-def cache_request(cache_filename, request, force_cache=False):
-  if os.path.exists(cache_filename) or force_cache:
-    with open(cache_filename, 'rb') as f:
-      return f.read()
+# Values in a Timeseries column are either missing (the day has no value for
+# that metric at all), present, or null (e.g. a source breakdown that a release
+# didn't give)
+MISSING = 0
+PRESENT = 1
+NULL = 2
+
+def date_to_day(date_string):
+  return datetime.date(int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10])).toordinal()
+
+def day_to_date(day):
+  return datetime.date.fromordinal(day).isoformat()
+
+class Timeseries(object):
+  # Column-oriented store for the assembled data, so that the gap filling
+  # passes work down whole columns rather than through a dict per day. Days
+  # are offsets from self.start; each column is an array of values and a
+  # bytearray of MISSING/PRESENT/NULL states. Sub-series such as sources are
+  # 'sources/<name>' columns, with the 'sources' column marking which days
+  # have a breakdown at all.
+  def __init__(self, start, length):
+    self.start = start
+    self.length = length
+    # Days with any data, and days fill_in_dates copied from the day before
+    self.rows = bytearray(length)
+    self.filled = bytearray(length)
+    self.columns = {}
+    # For each column, the days whose value was carried over from an earlier
+    # day rather than reported (by forward_fill, or copied before from_dict)
+    self.carried = {}
+
+  @classmethod
+  def from_dict(cls, data):
+    days = [date_to_day(d) for d in data.keys()]
+    ts = cls(min(days), max(days) - min(days) + 1)
+
+    for date_string, entry in data.iteritems():
+      i = date_to_day(date_string) - ts.start
+      ts.rows[i] = 1
+      copied = entry.get('copied', [])
+      for name, value in entry.iteritems():
+        if name == 'copied':
+          continue
+        if isinstance(value, dict):
+          ts.set(name, i, 0)
+          for sub_name, sub_value in value.iteritems():
+            ts.set(name + '/' + sub_name, i, sub_value)
+            if name in copied:
+              ts.mark_carried(name + '/' + sub_name, i)
+        else:
+          ts.set(name, i, value)
+        if name in copied:
+          ts.mark_carried(name, i)
+
+    return ts
+
+  def __len__(self):
+    return sum(self.rows)
+
+  def copy(self):
+    ts = Timeseries(self.start, self.length)
+    ts.rows = bytearray(self.rows)
+    ts.filled = bytearray(self.filled)
+    for name, (values, states) in self.columns.iteritems():
+      ts.columns[name] = (array.array('l', values), bytearray(states))
+    for name, carried in self.carried.iteritems():
+      ts.carried[name] = bytearray(carried)
+    return ts
+
+  def offset(self, date_string):
+    return date_to_day(date_string) - self.start
+
+  def dates(self):
+    return [day_to_date(self.start + i) for i in range(self.length) if self.rows[i]]
+
+  def extend(self, first_date, last_date):
+    # Grow the range of days to cover first_date to last_date
+    first_day = min(self.start, date_to_day(first_date))
+    last_day = max(self.start + self.length - 1, date_to_day(last_date))
+    before = self.start - first_day
+    after = last_day - (self.start + self.length - 1)
+
+    self.rows = bytearray(before) + self.rows + bytearray(after)
+    self.filled = bytearray(before) + self.filled + bytearray(after)
+    for name, (values, states) in self.columns.items():
+      values = array.array('l', [0]) * before + values + array.array('l', [0]) * after
+      self.columns[name] = (values, bytearray(before) + states + bytearray(after))
+    for name, carried in self.carried.items():
+      self.carried[name] = bytearray(before) + carried + bytearray(after)
+
+    self.start = first_day
+    self.length = last_day - first_day + 1
+
+  def column(self, name):
+    if name not in self.columns:
+      self.columns[name] = (array.array('l', [0]) * self.length, bytearray(self.length))
+    return self.columns[name]
+
+  def subseries_names(self, name):
+    prefix = name + '/'
+    return sorted(k[len(prefix):] for k in self.columns if k.startswith(prefix))
+
+  def has(self, name, i):
+    return name in self.columns and self.columns[name][1][i] != MISSING
+
+  def set(self, name, i, value):
+    values, states = self.column(name)
+    self.rows[i] = 1
+    if name in self.carried:
+      self.carried[name][i] = 0
+    if value is None:
+      values[i] = 0
+      states[i] = NULL
+    else:
+      values[i] = value
+      states[i] = PRESENT
+
+  def mark_carried(self, name, i):
+    self.carried.setdefault(name, bytearray(self.length))[i] = 1
+
+  def fill_missing(self, name, offsets, values):
+    # Like setdefault, days that already have a value (even a null one) keep it
+    for i, value in zip(offsets, values):
+      if not self.has(name, i):
+        self.set(name, i, value)
+
+  def forward_fill(self, name, initial):
+    # Carry the last value forward over days where this column is missing or null
+    values, states = self.column(name)
+    carried = self.carried.setdefault(name, bytearray(self.length))
+    last = initial
+    for i in range(self.length):
+      if not self.rows[i]:
+        continue
+      if states[i] == PRESENT:
+        last = values[i]
+      else:
+        values[i] = last
+        states[i] = PRESENT
+        carried[i] = 1
+
+  def fill_gaps(self):
+    # Days with no data at all get a copy of the day before
+    gaps = [i for i in range(1, self.length) if not self.rows[i]]
+    for values, states in self.columns.values():
+      for i in gaps:
+        values[i] = values[i - 1]
+        states[i] = states[i - 1]
+    for i in gaps:
+      self.rows[i] = 1
+      self.filled[i] = 1
+
+  def observed(self, name):
+    # Whether each day's value was actually reported, rather than missing or
+    # carried over from an earlier day by forward_fill or fill_gaps
+    values, states = self.column(name)
+    carried = self.carried.get(name, bytearray(self.length))
+    return [states[i] == PRESENT and not carried[i] and not self.filled[i] for i in range(self.length) if self.rows[i]]
+
+  def series(self, name, missing=None):
+    # The column as a list over the days with data, with nulls as None
+    if name not in self.columns:
+      return [missing] * len(self)
+    values, states = self.columns[name]
+    output = []
+    for i in range(self.length):
+      if not self.rows[i]:
+        continue
+      if states[i] == PRESENT:
+        output.append(values[i])
+      elif states[i] == NULL:
+        output.append(None)
+      else:
+        output.append(missing)
+    return output
+
+def cumulative_sum(values):
+  totals = []
+  total = 0
+  for value in values:
+    total += value
+    totals.append(total)
+  return totals
+
+def cache_request(cache_filename, request, force_cache=False, revalidate_after=None):
+  # request is called with any conditional GET headers, and returns the
+  # response. revalidate_after is how many seconds a cached copy is trusted
+  # for before checking it's still current, or None to trust it forever.
+  if cache_exists(cache_filename) or force_cache:
+    metadata = read_cache_metadata(cache_filename)
+    if force_cache or revalidate_after is None or time.time() - metadata.get('checked_at', 0) < revalidate_after:
+      return cache_read(cache_filename)
+
+    headers = {}
+    if metadata.get('etag'):
+      headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+      headers['If-Modified-Since'] = metadata['last_modified']
+
+    # A good copy is already cached, so failing to check it (the page being
+    # removed, the site being down) just means using it as it is
+    import requests
+    try:
+      response = request(headers)
+    except requests.RequestException as e:
+      log('Using cached %s, revalidating it failed: %r' % (cache_filename, e))
+      return cache_read(cache_filename)
+    if response.status_code == 304:
+      metadata['checked_at'] = time.time()
+      write_cache_metadata(cache_filename, metadata)
+      return cache_read(cache_filename)
+    if response.status_code != 200:
+      log('Using cached %s, revalidating it got HTTP %d' % (cache_filename, response.status_code))
+      return cache_read(cache_filename)
   else:
-    result = request()
-    with open(cache_filename, 'wb') as f:
-      f.write(result.encode('utf-8'))
-    return result
+    response = request({})
+
+  response.raise_for_status()
+  result = response.text
+  cache_write(cache_filename, result.encode('utf-8'))
+
+  write_cache_metadata(cache_filename, {
+    'etag': response.headers.get('ETag'),
+    'last_modified': response.headers.get('Last-Modified'),
+    'checked_at': time.time(),
+  })
+
+  return result
+
+def read_cache_metadata(cache_filename):
+  # Validators for conditional GETs live next to the cached body
+  if not cache_exists(cache_filename + '.meta'):
+    return {}
+  return json.loads(cache_read(cache_filename + '.meta'))
+
+def write_cache_metadata(cache_filename, metadata):
+  cache_write(cache_filename + '.meta', json.dumps(metadata, sort_keys=True))
+
+# Once data_cache/ has been migrated into a pack file (see --migrate-cache),
+# everything that used to be a file under data_cache/ is read from and written
+# to the pack instead, under the same name. The exception is what's derived
+# from the cache, which stays as plain files.
+CACHE_PACK_FILE = 'data_cache.pack'
+
+cache_pack = None
+
+def get_cache_pack():
+  global cache_pack
+  if cache_pack is None and os.path.exists(CACHE_PACK_FILE):
+    cache_pack = CachePack(CACHE_PACK_FILE)
+  return cache_pack
+
+def cache_exists(cache_filename):
+  pack = get_cache_pack()
+  if pack is not None:
+    return pack.get(cache_filename) is not None
+  return os.path.exists(cache_filename)
+
+def cache_read(cache_filename):
+  pack = get_cache_pack()
+  if pack is not None:
+    content = pack.get(cache_filename)
+    if content is None:
+      raise IOError('%s is not in %s' % (cache_filename, pack.filename))
+    return content
+
+  with open(cache_filename, 'rb') as f:
+    return f.read()
+
+def cache_write(cache_filename, content):
+  pack = get_cache_pack()
+  if pack is not None:
+    pack.put(cache_filename, content)
+    return
+
+  with open(cache_filename, 'wb') as f:
+    f.write(content)
+
+def cache_list(directory):
+  pack = get_cache_pack()
+  if pack is not None:
+    prefix = os.path.join(directory, '')
+    return [k[len(prefix):] for k in pack.keys() if k.startswith(prefix) and '/' not in k[len(prefix):]]
+  return os.listdir(directory)
+
+def flush_cache():
+  pack = get_cache_pack()
+  if pack is not None:
+    pack.flush()
+
+# Pack layout: a magic header, then the zlib-compressed blobs (one per distinct
+# content hash), then the key names, then a fixed-width index sorted by key
+# hash that can be binary searched in place, then a footer pointing at the
+# index
+CACHE_PACK_MAGIC = 'NZPACK01'
+CACHE_PACK_RECORD = struct.Struct('>20s20sQIQI')
+CACHE_PACK_FOOTER = struct.Struct('>QI8s')
+
+class CachePack(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.pending = {}
+    # Fetch threads, and scripts sharing the pack under tools/run_hourly.py,
+    # may use it at the same time, and flush() remaps the file
+    self.lock = threading.RLock()
+    self.map = None
+    self.index_offset = 0
+    self.count = 0
+    self.open()
+
+  def open(self):
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+
+    if not os.path.exists(self.filename):
+      return
+
+    with open(self.filename, 'rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    self.index_offset, self.count, magic = CACHE_PACK_FOOTER.unpack_from(self.map, len(self.map) - CACHE_PACK_FOOTER.size)
+    if self.map[:len(CACHE_PACK_MAGIC)] != CACHE_PACK_MAGIC or magic != CACHE_PACK_MAGIC:
+      raise ValueError('%s is not a cache pack' % self.filename)
+
+  def record(self, i):
+    return CACHE_PACK_RECORD.unpack_from(self.map, self.index_offset + i * CACHE_PACK_RECORD.size)
+
+  def record_key(self, record):
+    _, _, _, _, key_offset, key_length = record
+    return self.map[key_offset:key_offset + key_length]
+
+  def find(self, key):
+    key_hash = hashlib.sha1(key).digest()
+    lo = 0
+    hi = self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      record = self.record(mid)
+      if record[0] < key_hash:
+        lo = mid + 1
+      elif record[0] > key_hash:
+        hi = mid
+      else:
+        return record
+    return None
+
+  def get(self, key):
+    with self.lock:
+      if key in self.pending:
+        return self.pending[key]
+
+      record = self.find(key)
+      if record is None:
+        return None
+
+      _, _, blob_offset, blob_length, _, _ = record
+      blob = self.map[blob_offset:blob_offset + blob_length]
+    return zlib.decompress(blob)
+
+  def put(self, key, content):
+    with self.lock:
+      self.pending[key] = content
+
+  def keys(self):
+    with self.lock:
+      keys = set(self.pending.keys())
+      for i in range(self.count):
+        keys.add(self.record_key(self.record(i)))
+    return sorted(keys)
+
+  def flush(self):
+    with self.lock:
+      self.flush_pending()
+
+  def flush_pending(self):
+    if not self.pending:
+      return
+
+    # Existing blobs are copied across still compressed, so only new content
+    # gets compressed
+    blobs = collections.OrderedDict()
+    entries = {}
+    for i in range(self.count):
+      record = self.record(i)
+      _, blob_hash, blob_offset, blob_length, _, _ = record
+      key = self.record_key(record)
+      if key not in self.pending:
+        # A buffer, so the pack isn't copied into memory to be rewritten
+        if blob_hash not in blobs:
+          blobs[blob_hash] = buffer(self.map, blob_offset, blob_length)
+        entries[key] = blob_hash
+
+    for key, content in self.pending.iteritems():
+      blob_hash = hashlib.sha1(content).digest()
+      if blob_hash not in blobs:
+        blobs[blob_hash] = zlib.compress(content, 9)
+      entries[key] = blob_hash
+
+    write_cache_pack(self.filename, blobs, entries)
+    self.pending = {}
+    self.open()
+
+def write_cache_pack(filename, blobs, entries):
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    f.write(CACHE_PACK_MAGIC)
+
+    blob_locations = {}
+    for blob_hash, compressed in blobs.iteritems():
+      blob_locations[blob_hash] = (f.tell(), len(compressed))
+      f.write(compressed)
+
+    records = []
+    for key in sorted(entries.keys()):
+      key_offset = f.tell()
+      f.write(key)
+      blob_offset, blob_length = blob_locations[entries[key]]
+      records.append((hashlib.sha1(key).digest(), entries[key], blob_offset, blob_length, key_offset, len(key)))
+
+    index_offset = f.tell()
+    for record in sorted(records):
+      f.write(CACHE_PACK_RECORD.pack(*record))
+    f.write(CACHE_PACK_FOOTER.pack(index_offset, len(records), CACHE_PACK_MAGIC))
+
+  os.rename(tmp_filename, filename)
+
+DERIVED_CACHE_FILES = [EXTRACTION_CACHE_FILE, SUMMARY_RECORD_FILE, RELEASE_LIST_FILE, FRONTIER_FILE]
+
+def migrate_cache_to_pack(cache_dir='data_cache', pack_filename=CACHE_PACK_FILE):
+  pack = CachePack(pack_filename)
+  raw_size = 0
+  for dirpath, _, filenames in os.walk(cache_dir):
+    for filename in filenames:
+      path = os.path.join(dirpath, filename)
+      # Derived files stay plain files, and nothing reads them from the pack
+      if path in DERIVED_CACHE_FILES or path.endswith('.tmp'):
+        continue
+
+      with open(path, 'rb') as f:
+        content = f.read()
+      pack.put(path, content)
+      raw_size += len(content)
+
+  count = len(pack.pending)
+  pack.flush()
+  log('Packed %d files (%d bytes) from %s/ into %s (%d bytes)' % (count, raw_size, cache_dir, pack_filename, os.path.getsize(pack_filename)))
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--profile', metavar='REPORT',
+                      help='time each stage, release and pattern, and write a JSON report here')
+  parser.add_argument('--migrate-cache', action='store_true',
+                      help='pack data_cache/ into %s and exit' % CACHE_PACK_FILE)
+  parser.add_argument('--format', action='append', choices=OUTPUT_FORMATS.keys(),
+                      help='output format, can be given more than once: %s (default: json)' % ', '.join('%s writes %s' % (k, filename) for k, (filename, _) in OUTPUT_FORMATS.iteritems()))
+  parser.add_argument('--render-only', action='store_true',
+                      help='rebuild nzl.json from previously extracted values, without fetching or parsing anything')
+  parser.add_argument('--daemon', action='store_true',
+                      help='keep running, polling for new media releases and case numbers, and update nzl.json when they change')
+  parser.add_argument('--poll-interval', type=float, default=10, metavar='MINUTES',
+                      help='how often the daemon polls (default: %(default)s)')
+  parser.add_argument('--poll-jitter', type=float, default=0.2, metavar='FRACTION',
+                      help='randomly vary the poll interval by up to this fraction of it (default: %(default)s)')
+  parser.add_argument('--full-crawl', action='store_true',
+                      help='read the whole media release listing, rather than stopping once it reaches releases seen before')
+  parser.add_argument('--listing-window', type=int, default=4,
+                      help='number of media release listing pages fetched ahead at once (default: %(default)s)')
+  parser.add_argument('--base-url', default=BASE_URL,
+                      help='site to fetch from, e.g. a tools/standin_server.py (default: %(default)s)')
+  parser.add_argument('--poll-summary', action='store_true',
+                      help='save a snapshot of the current cases page before building the output (--daemon always does)')
+  parser.add_argument('--no-raw-snapshots', dest='raw_snapshots', action='store_false',
+                      help='only store the parsed tables from the current cases page, not the page itself')
+  parser.add_argument('--fetch-concurrency', type=int, default=8,
+                      help='number of media releases downloaded at once (default: %(default)s)')
+  parser.add_argument('--per-host-connections', type=int, default=http_options['per_host'],
+                      help='most connections open to any one host at once (default: %(default)s)')
+  parser.add_argument('--fetch-timeout', type=float, default=http_options['timeout'], metavar='SECONDS',
+                      help='give up on a request after this long (default: %(default)s)')
+  parser.add_argument('--fetch-retries', type=int, default=http_options['retries'],
+                      help='times a failed or timed out request is retried (default: %(default)s)')
+  parser.add_argument('--fetch-backoff', type=float, default=http_options['backoff'], metavar='SECONDS',
+                      help='base of the exponential backoff between retries (default: %(default)s)')
+  parser.add_argument('--revalidate-after', type=float, default=None, metavar='HOURS',
+                      help='check cached media releases are still current once they are this old (default: never)')
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                      help='number of processes used to parse media releases (default: %(default)s)')
+  parser.add_argument('--extraction-cache', default=EXTRACTION_CACHE_FILE,
+                      help='file caching the values extracted from each media release (default: %(default)s)')
+  parser.add_argument('--no-extraction-cache', dest='extraction_cache', action='store_const', const=None,
+                      help='re-extract every media release and summary page snapshot from scratch')
+  parser.add_argument('--document-budget', type=float, default=60,
+                      help='seconds a single media release may spend being parsed before it is skipped, 0 to disable (default: %(default)s)')
+  parser.add_argument('--pattern-budget', type=float, default=5,
+                      help='seconds a single regex may take on a media release before it is reported as slow, 0 to disable (default: %(default)s)')
+  return parser.parse_args(argv)
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main(parse_args())
\ No newline at end of file
@@ -0,0 +1,217 @@
+#!/usr/bin/env python2
+
+# Offline benchmark of each stage of the NZ pipeline, run against data_cache/
+# and data_cache/summary/ with the stand-in server playing www.health.govt.nz.
+#
+# Each stage is timed on its own and compared with the stored baseline. A
+# stage is run --repeat times, each a fixed number of calls (enough to take
+# --min-time the first time round), and its time is the median of the runs'
+# median calls. How far those medians spread is recorded as the stage's noise.
+#
+# A stage only counts as a regression if it's slower than the baseline by
+# more than --threshold, and also by more than twice its noise, which is what
+# keeps sub-millisecond stages from failing on a busy machine. The baseline
+# is the median of --baseline-runs whole benchmarks, with the spread between
+# them counted as noise too. Timings are machine specific, so regenerate the
+# baseline with --update-baseline when moving to a different machine.
+
+import argparse
+import collections
+import copy
+import json
+import os
+import re
+import sys
+import time
+
+import standin_server
+from hourly import nz, ROOT
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+def reset_peak_rss():
+  # The process's peak RSS only ever goes up, so on its own it would give
+  # every stage the peak of the biggest one before it. Linux lets it be reset
+  # (by writing 5 to clear_refs), making it the peak of just what runs next.
+  # Elsewhere memory isn't reported.
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except IOError:
+    return False
+
+def read_rss_mb():
+  # The current and peak RSS, in MB
+  with open('/proc/self/status') as f:
+    status = f.read()
+  return tuple(int(re.search(r'%s:\s+(\d+) kB' % k, status).group(1)) / 1024.0 for k in ('VmRSS', 'VmHWM'))
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+def run_stage(results, name, fn, documents, repeat, min_time, setup=None):
+  calls = None
+  medians = []
+  peak = None
+  growth = None
+  result = None
+  for _ in range(repeat):
+    call_times = []
+    elapsed = 0
+    # The first run decides how many calls each run makes
+    while not call_times or (len(call_times) < calls if calls is not None else elapsed < min_time):
+      arg = setup() if setup is not None else None
+      measure_rss = reset_peak_rss()
+      if measure_rss:
+        start_rss, _ = read_rss_mb()
+      start_time = time.time()
+      result = fn(arg) if setup is not None else fn()
+      call_times.append(time.time() - start_time)
+      elapsed += call_times[-1]
+      if measure_rss:
+        _, call_peak = read_rss_mb()
+        peak = max(peak, call_peak)
+        growth = max(growth, call_peak - start_rss)
+
+    calls = len(call_times)
+    medians.append(median(call_times))
+
+  seconds = median(medians)
+  count = documents(result) if callable(documents) else documents
+  results[name] = {
+    'seconds': seconds,
+    'noise': max(medians) - min(medians),
+    'calls': calls,
+    'documents': count,
+    'documents_per_second': count / seconds if seconds > 0 else None,
+    'peak_rss_mb': peak,
+    'rss_growth_mb': growth,
+  }
+  return result
+
+def run_benchmark(repeat, min_time):
+  os.chdir(ROOT)
+  results = collections.OrderedDict()
+
+  server = standin_server.start_server()
+  listing_url = server.base_url() + standin_server.LISTING_PATH
+
+  post_list = run_stage(results, 'listing', lambda: nz.get_media_release_list(listing_url), len, repeat, min_time)
+  bodies = run_stage(results, 'fetch', lambda: [nz.fetch_text(post_url) for post_url in post_list], len, repeat, min_time)
+  parsed = run_stage(results, 'parse', lambda: [nz.parse_media_release(body) for body in bodies], len, repeat, min_time)
+
+  body_hashes = [nz.hash_body(body) for body in bodies]
+  records = run_stage(
+    results,
+    'extract',
+    lambda: [nz.extract_release_record(h, date_string, content, None) for h, (date_string, content) in zip(body_hashes, parsed)],
+    len([content for _, content in parsed if content is not None]),
+    repeat,
+    min_time
+  )
+
+  data = nz.merge_media_release_records(records)
+  data = run_stage(results, 'summary', lambda d: nz.get_timeseries_data_summary_page(d, None), len, repeat, min_time, setup=lambda: copy.deepcopy(data))
+
+  data = nz.Timeseries.from_dict(data)
+  data = run_stage(results, 'add_manual_data', nz.add_manual_data, len, repeat, min_time, setup=data.copy)
+  data = run_stage(results, 'fill_in_blanks', nz.fill_in_blanks, len, repeat, min_time, setup=data.copy)
+  data = run_stage(results, 'fill_in_dates', nz.fill_in_dates, len, repeat, min_time, setup=data.copy)
+
+  dates = data.dates()
+  run_stage(results, 'munge_data_to_output', lambda: nz.munge_data_to_output(data, dates, 'sources'), len(dates), repeat, min_time)
+
+  formatted_data = nz.format_output(data)
+  run_stage(results, 'serialize', lambda: json.dumps(formatted_data, indent=2, sort_keys=True), len(dates), repeat, min_time)
+
+  server.shutdown()
+  return results
+
+def merge_runs(runs):
+  # The median of several whole benchmarks, for the baseline. How much a
+  # stage varied between them counts towards its noise.
+  merged = collections.OrderedDict()
+  for name, result in runs[0].iteritems():
+    stage_runs = [run[name] for run in runs]
+    seconds = [r['seconds'] for r in stage_runs]
+    merged[name] = dict(result)
+    merged[name]['seconds'] = median(seconds)
+    merged[name]['noise'] = max([max(seconds) - min(seconds)] + [r['noise'] for r in stage_runs])
+    merged[name]['documents_per_second'] = result['documents'] / merged[name]['seconds'] if merged[name]['seconds'] > 0 else None
+  return merged
+
+def compare(results, baseline, threshold, min_delta):
+  # A stage has to be slower than its baseline by more than the threshold, and
+  # by more than twice the baseline's noise (or min_delta, if that's larger),
+  # so quick stages on a busy machine don't fail at random
+  regressions = []
+  for name, result in results.iteritems():
+    if name not in baseline:
+      continue
+    baseline_seconds = baseline[name]['seconds']
+    floor = max(min_delta, 2 * baseline[name].get('noise', 0))
+    if result['seconds'] > baseline_seconds * (1 + threshold) and result['seconds'] - baseline_seconds > floor:
+      regressions.append((name, baseline_seconds, result['seconds']))
+  return regressions
+
+def print_results(results, baseline):
+  print '%-22s %10s %10s %10s %12s %10s %10s' % ('stage', 'seconds', 'noise', 'baseline', 'docs/s', 'peak MB', 'growth MB')
+  for name, result in results.iteritems():
+    baseline_seconds = baseline.get(name, {}).get('seconds')
+    print '%-22s %10.6f %10.6f %10s %12s %10s %10s' % (
+      name,
+      result['seconds'],
+      result['noise'],
+      '%.6f' % baseline_seconds if baseline_seconds is not None else '-',
+      '%.1f' % result['documents_per_second'] if result['documents_per_second'] is not None else '-',
+      '%.1f' % result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-',
+      '%.1f' % result['rss_growth_mb'] if result['rss_growth_mb'] is not None else '-',
+    )
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='runs of each stage, of which the median counts (default: %(default)s)')
+  parser.add_argument('--threshold', type=float, default=0.25,
+                      help='fractional slowdown against the baseline that counts as a regression (default: %(default)s)')
+  parser.add_argument('--min-delta', type=float, default=0.0001,
+                      help='seconds a stage must slow down by, at least, before it can count as a regression (default: %(default)s)')
+  parser.add_argument('--min-time', type=float, default=0.2,
+                      help='seconds the first run of a stage is repeated for, at least (default: %(default)s)')
+  parser.add_argument('--baseline-runs', type=int, default=3,
+                      help='whole benchmarks the baseline is taken from, with --update-baseline (default: %(default)s)')
+  parser.add_argument('--baseline', default=BASELINE_FILE)
+  parser.add_argument('--update-baseline', action='store_true',
+                      help='store these results as the new baseline')
+  parser.add_argument('--output', help='also write the results as JSON to this file')
+  args = parser.parse_args()
+
+  baseline = {}
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+
+  if args.update_baseline:
+    results = merge_runs([run_benchmark(args.repeat, args.min_time) for _ in range(args.baseline_runs)])
+  else:
+    results = run_benchmark(args.repeat, args.min_time)
+  print_results(results, baseline)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+
+  if args.update_baseline:
+    with open(args.baseline, 'w') as f:
+      json.dump(results, f, indent=2)
+    sys.exit(0)
+
+  regressions = compare(results, baseline, args.threshold, args.min_delta)
+  for name, baseline_seconds, seconds in regressions:
+    print 'REGRESSION: %s took %.6fs against a baseline of %.6fs' % (name, seconds, baseline_seconds)
+  sys.exit(1 if regressions else 0)
@@ -0,0 +1,9 @@
+# scripts.hourly/50-nz.py can't be imported by name, so load it by path for the
+# tools that reuse its pipeline. It expects to be run from the repository root.
+
+import imp
+import os
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+nz = imp.load_source('nz_hourly', os.path.join(ROOT, 'scripts.hourly', '50-nz.py'))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+
+# Load test of the fetch path: a full crawl (every listing page, every media
+# release and the current cases page) from a cold cache, against the stand-in
+# server, reporting throughput and tail latency.
+#
+# The crawl runs in a scratch directory, so the real data_cache/ is only ever
+# read (by the stand-in server). The stand-in can be made slow or unreliable
+# with the same options as tools/standin_server.py, or --base-url can point at
+# one that's already running.
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import standin_server
+from hourly import nz
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def record_requests(latencies, sizes):
+  # Time every request the script makes, including reading the body
+  lock = threading.Lock()
+  http_get = nz.http_get
+
+  def timed_http_get(url, headers=None):
+    start_time = time.time()
+    response = http_get(url, headers=headers)
+    size = len(response.content)
+    with lock:
+      latencies.append(time.time() - start_time)
+      sizes.append(size)
+    return response
+
+  nz.http_get = timed_http_get
+
+def crawl(base_url, listing_window, fetch_concurrency):
+  stages = {}
+
+  start_time = time.time()
+  post_list = nz.get_media_release_list(base_url + nz.MEDIA_RELEASES_PATH, window=listing_window)
+  stages['listing'] = time.time() - start_time
+
+  start_time = time.time()
+  skipped = len([body_hash for _, body_hash in nz.fetch_media_releases(post_list, concurrency=fetch_concurrency) if body_hash is None])
+  stages['releases'] = time.time() - start_time
+
+  start_time = time.time()
+  nz.poll_and_update_summary_page(base_url + nz.CURRENT_CASES_PATH)
+  stages['summary'] = time.time() - start_time
+
+  return len(post_list), skipped, stages
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--base-url',
+                      help='crawl this server instead of starting a stand-in')
+  parser.add_argument('--listing-window', type=int, default=4)
+  parser.add_argument('--fetch-concurrency', type=int, default=8)
+  parser.add_argument('--per-host-connections', type=int, default=nz.http_options['per_host'])
+  parser.add_argument('--fetch-retries', type=int, default=nz.http_options['retries'])
+  parser.add_argument('--fetch-backoff', type=float, default=nz.http_options['backoff'])
+  parser.add_argument('--fetch-timeout', type=float, default=nz.http_options['timeout'])
+  standin_server.add_fault_arguments(parser)
+  args = parser.parse_args()
+
+  server = None
+  base_url = args.base_url
+  if base_url is None:
+    server = standin_server.start_server(**standin_server.fault_options(args))
+    base_url = server.base_url()
+
+  nz.configure_http(timeout=args.fetch_timeout, per_host=args.per_host_connections, retries=args.fetch_retries, backoff=args.fetch_backoff)
+  latencies = []
+  sizes = []
+  record_requests(latencies, sizes)
+
+  scratch_dir = tempfile.mkdtemp()
+  os.makedirs(os.path.join(scratch_dir, 'data_cache', 'summary'))
+  os.chdir(scratch_dir)
+  try:
+    start_time = time.time()
+    releases, skipped, stages = crawl(base_url, args.listing_window, args.fetch_concurrency)
+    elapsed = time.time() - start_time
+  finally:
+    shutil.rmtree(scratch_dir)
+
+  latencies.sort()
+  print 'Crawled %d releases (%d skipped) with %d requests in %.2fs' % (releases, skipped, len(latencies), elapsed)
+  for name in ('listing', 'releases', 'summary'):
+    print '  %-10s %8.2fs' % (name, stages[name])
+  print 'Throughput: %.1f requests/s, %.2f MB/s' % (len(latencies) / elapsed, sum(sizes) / elapsed / (1024 * 1024))
+  print 'Latency: p50 %.3fs, p95 %.3fs, p99 %.3fs, max %.3fs' % (
+    percentile(latencies, 0.5),
+    percentile(latencies, 0.95),
+    percentile(latencies, 0.99),
+    latencies[-1],
+  )
+  if server is not None:
+    counters = server.counters
+    print 'Stand-in: %d requests, %d failed, %d reset' % (counters['requests'], counters['failures'], counters['resets'])
+    server.shutdown()
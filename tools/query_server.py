@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+
+# A small read API over nzl.json, for consumers that only want part of it.
+#
+# The file is loaded into a TimeseriesIndex, which answers date range, metric
+# and source breakdown queries, and remembers the answers. TimeseriesStore
+# reloads the index whenever nzl.json changes, swapping the new one in whole so
+# a query never sees a half updated index. Use either from Python, e.g.
+#
+#   store = TimeseriesStore('nzl.json')
+#   store.get().total('confirmed', '2020-04-01', '2020-04-30')
+#
+# or over HTTP:
+#
+#   /dates
+#   /total                        all the totals
+#   /total/confirmed?from=2020-04-01&to=2020-04-30
+#   /sources?from=2020-04-01      every source
+#   /sources/Overseas acquired
+
+import argparse
+import BaseHTTPServer
+import bisect
+import hashlib
+import json
+import os
+import SocketServer
+import threading
+import urllib
+import urlparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+class TimeseriesIndex(object):
+  def __init__(self, data, version):
+    self.version = version
+    self.dates = data['timeseries_dates']
+    self.totals = data['total']
+    self.sources = data['sources']['subseries']
+    self.source_keys = data['sources']['keys']
+    self.memo = {}
+    self.memo_lock = threading.Lock()
+
+  def date_range(self, start=None, end=None):
+    # Dates are ISO formatted, so sort the same as strings and can be
+    # bisected for the slice covering start..end (inclusive)
+    first = bisect.bisect_left(self.dates, start) if start else 0
+    last = bisect.bisect_right(self.dates, end) if end else len(self.dates)
+    return first, last
+
+  def memoized(self, key, compute):
+    # Answers are remembered by the slice of dates they cover, so different
+    # ways of writing the same range share an entry
+    with self.memo_lock:
+      if key in self.memo:
+        return self.memo[key]
+    result = compute()
+    with self.memo_lock:
+      self.memo[key] = result
+    return result
+
+  def total(self, metric, start=None, end=None):
+    first, last = self.date_range(start, end)
+    return self.memoized(('total', metric, first, last), lambda: {
+      'dates': self.dates[first:last],
+      'values': self.totals[metric][first:last],
+    })
+
+  def all_totals(self, start=None, end=None):
+    first, last = self.date_range(start, end)
+    return self.memoized(('all_totals', first, last), lambda: {
+      'dates': self.dates[first:last],
+      'total': dict((metric, values[first:last]) for metric, values in self.totals.iteritems()),
+    })
+
+  def source_breakdown(self, source=None, start=None, end=None):
+    first, last = self.date_range(start, end)
+    keys = [source] if source is not None else self.source_keys
+    return self.memoized(('sources', source, first, last), lambda: {
+      'dates': self.dates[first:last],
+      'keys': keys,
+      'subseries': dict((k, self.sources[k][first:last]) for k in keys),
+    })
+
+class TimeseriesStore(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.index = None
+    self.stat = None
+    self.lock = threading.Lock()
+
+  def get(self):
+    # Rebuild the index if the file has changed since it was loaded. The
+    # output is replaced by rename, so a changed inode/mtime/size means a
+    # complete new file.
+    st = os.stat(self.filename)
+    stat = (st.st_ino, st.st_mtime, st.st_size)
+    if stat != self.stat:
+      with self.lock:
+        if stat != self.stat:
+          with open(self.filename, 'rb') as f:
+            content = f.read()
+          self.index = TimeseriesIndex(json.loads(content), hashlib.sha1(content).hexdigest())
+          self.stat = stat
+    return self.index
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).iteritems())
+    parts = [urllib.unquote(p) for p in url.path.strip('/').split('/')]
+    index = self.server.store.get()
+
+    try:
+      result = self.lookup(index, parts, query.get('from'), query.get('to'))
+    except KeyError:
+      result = None
+
+    if result is None:
+      self.send_response(404)
+      self.end_headers()
+      return
+
+    # Answers only change when the index does
+    etag = '"%s"' % index.version
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.end_headers()
+      return
+
+    body = json.dumps(result, sort_keys=True)
+    self.send_response(200)
+    self.send_header('ETag', etag)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def lookup(self, index, parts, start, end):
+    if parts == ['dates']:
+      return index.dates
+    if parts == ['total']:
+      return index.all_totals(start, end)
+    if len(parts) == 2 and parts[0] == 'total':
+      return index.total(parts[1], start, end)
+    if parts == ['sources']:
+      return index.source_breakdown(None, start, end)
+    if len(parts) == 2 and parts[0] == 'sources':
+      return index.source_breakdown(parts[1], start, end)
+    return None
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, filename=os.path.join(ROOT, 'nzl.json'), verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+    self.store = TimeseriesStore(filename)
+    self.verbose = verbose
+
+  def base_url(self):
+    return 'http://%s:%d' % self.server_address
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=8001)
+  parser.add_argument('--file', default=os.path.join(ROOT, 'nzl.json'),
+                      help='output to serve, reloaded whenever it changes (default: %(default)s)')
+  args = parser.parse_args()
+
+  server = QueryServer(('127.0.0.1', args.port), filename=args.file, verbose=True)
+  print 'Serving %s on %s' % (args.file, server.base_url())
+  server.serve_forever()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+
+# Runs every scripts.hourly/NN-name.py in one process, rather than each one
+# starting from cold.
+#
+# Scripts are run in order of their NN prefix. Scripts sharing a prefix don't
+# depend on each other, so they run at the same time. All of them share one
+# HTTP session and one cache pack, so connections and the cache are only set
+# up once, and only if some script actually uses them. Any arguments not
+# recognised here (e.g. --render-only) are passed on to every script.
+
+import argparse
+import collections
+import imp
+import multiprocessing.pool
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SCRIPT_DIR = os.path.join(ROOT, 'scripts.hourly')
+SCRIPT_NAME = re.compile(r'^(\d+)-(.+)\.py$')
+
+# Module globals that hold the shared resources, and the functions that
+# lazily create them
+SHARED_RESOURCES = [
+  ('http_session', 'get_http_session'),
+  ('cache_pack', 'get_cache_pack'),
+]
+
+def discover_scripts(script_dir):
+  groups = collections.defaultdict(list)
+  for filename in os.listdir(script_dir):
+    m = SCRIPT_NAME.match(filename)
+    if m:
+      groups[int(m.group(1))].append(os.path.join(script_dir, filename))
+
+  return collections.OrderedDict((prefix, sorted(groups[prefix])) for prefix in sorted(groups.keys()))
+
+def load_script(path):
+  name = SCRIPT_NAME.match(os.path.basename(path)).group(2)
+  return imp.load_source('hourly_%s' % re.sub(r'\W', '_', name), path)
+
+def share_resources(modules):
+  # Each script's getter is wrapped, so nothing is created (or imported) until
+  # a script asks for it. The first script to ask creates the resource, after
+  # its own configuration, and the rest are handed that one when they first
+  # ask. After that each script's getter is left to itself, so a script that
+  # throws its resource away (e.g. reconfiguring HTTP) gets a new one of its
+  # own.
+  shared = {}
+  lock = threading.RLock()
+  for module in modules:
+    for attr, getter in SHARED_RESOURCES:
+      if hasattr(module, getter):
+        setattr(module, getter, shared_getter(module, attr, getattr(module, getter), shared, lock))
+
+def shared_getter(module, attr, create, shared, lock):
+  asked = []
+
+  def get():
+    if not asked:
+      with lock:
+        if not asked:
+          if shared.get(attr) is not None and getattr(module, attr) is None:
+            setattr(module, attr, shared[attr])
+          resource = create()
+          if resource is not None:
+            shared.setdefault(attr, resource)
+          asked.append(True)
+          return resource
+    return create()
+
+  return get
+
+def run_script(module, argv):
+  start_time = time.time()
+  try:
+    if hasattr(module, 'parse_args'):
+      module.main(module.parse_args(argv))
+    else:
+      module.main()
+    error = None
+  except (Exception, SystemExit):
+    error = traceback.format_exc()
+  return time.time() - start_time, error
+
+def run_all(groups, argv, jobs):
+  results = collections.OrderedDict()
+
+  modules = dict((path, load_script(path)) for scripts in groups.values() for path in scripts)
+  share_resources(modules.values())
+
+  pool = multiprocessing.pool.ThreadPool(jobs)
+  try:
+    for prefix, scripts in groups.iteritems():
+      group_results = pool.map(lambda path: run_script(modules[path], argv), scripts)
+      for path, result in zip(scripts, group_results):
+        results[os.path.basename(path)] = result
+  finally:
+    pool.close()
+    pool.join()
+
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--jobs', type=int, default=4,
+                      help='most scripts run at the same time (default: %(default)s)')
+  parser.add_argument('--script-dir', default=SCRIPT_DIR)
+  args, script_argv = parser.parse_known_args()
+
+  os.chdir(ROOT)
+  start_time = time.time()
+  results = run_all(discover_scripts(args.script_dir), script_argv, args.jobs)
+
+  print '%-30s %10s' % ('script', 'seconds')
+  for name, (seconds, error) in results.iteritems():
+    print '%-30s %10.2f%s' % (name, seconds, '  FAILED' if error else '')
+  print '%-30s %10.2f' % ('total', time.time() - start_time)
+
+  failed = False
+  for name, (seconds, error) in results.iteritems():
+    if error:
+      failed = True
+      sys.stderr.write('%s failed:\n%s' % (name, error))
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python2
+
+# A local stand-in for www.health.govt.nz, serving what's in data_cache/.
+#
+# The media release listing isn't cached, so its pages are rebuilt from the
+# cached releases (newest first, ending with a 2019 post like the real one).
+# Point the crawler at it with e.g.
+#
+#   get_media_release_list('http://127.0.0.1:8000/news-media/media-releases')
+#
+# or run the whole script against it, from a scratch directory so the real
+# cache isn't touched:
+#
+#   python scripts.hourly/50-nz.py --base-url http://127.0.0.1:8000
+#
+# It can also be made slow or unreliable (--latency, --bandwidth,
+# --failure-rate, --reset-rate), e.g. for tools/load_test.py.
+
+import argparse
+import BaseHTTPServer
+import collections
+import hashlib
+import os
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_cache')
+CACHE_PREFIX = 'https:__www.health.govt.nz'
+
+LISTING_PATH = '/news-media/media-releases'
+SUMMARY_PATH = '/our-work/diseases-and-conditions/covid-19-novel-coronavirus/covid-19-current-situation/covid-19-current-cases'
+
+def load_listing(cache_dir, page_size):
+  items = []
+  for filename in os.listdir(cache_dir):
+    if not filename.startswith(CACHE_PREFIX) or not filename.endswith('.html'):
+      continue
+
+    with open(os.path.join(cache_dir, filename), 'rb') as f:
+      m = re.search(r'date-display-single[^>]*content="([^"]+)"', f.read())
+    if m:
+      items.append((m.group(1), filename[len(CACHE_PREFIX):-len('.html')].replace('_', '/'), 'COVID-19 media release'))
+
+  items.sort(reverse=True)
+  # The real listing carries on into 2019, which is where the crawler stops
+  items.append(('2019-12-20T00:00:00+13:00', LISTING_PATH + '/2019-release', 'Release from 2019'))
+
+  pages = []
+  for i in range(0, len(items), page_size):
+    pages.append(render_listing_page(items[i:i + page_size]))
+  return pages
+
+def render_listing_page(items):
+  lis = []
+  for date, path, title in items:
+    lis.append(
+      '<li>'
+      '<div class="views-field-title"><span class="field-content"><a href="%s">%s</a></span></div>'
+      '<div class="views-field-field-news-type"><div class="field-content">Media release</div></div>'
+      '<span class="date-display-single" content="%s">%s</span>'
+      '</li>' % (path, title, date, date.split('T')[0])
+    )
+  return '<html><body><div class="view-content"><div class="item-list"><ul>%s</ul></div></div></body></html>' % ''.join(lis)
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.server.count('requests')
+
+    # Behave like a slow or flaky site, if asked to
+    if self.server.latency:
+      time.sleep(self.server.latency)
+    if random.random() < self.server.reset_rate:
+      # Hang up without answering
+      self.server.count('resets')
+      self.close_connection = True
+      return
+    if random.random() < self.server.failure_rate:
+      self.server.count('failures')
+      self.send_response(random.choice(self.server.failure_statuses))
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+
+    url = urlparse.urlparse(self.path)
+    body = self.server.lookup(url.path, urlparse.parse_qs(url.query))
+
+    if body is None:
+      self.send_response(404)
+      self.end_headers()
+      return
+
+    # Support conditional GETs the way the real site does
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.end_headers()
+      return
+
+    self.send_response(200)
+    self.send_header('ETag', etag)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.write_body(body)
+
+  def write_body(self, body):
+    if not self.server.bandwidth:
+      self.wfile.write(body)
+    else:
+      # Send a tenth of a second's worth at a time
+      chunk_size = max(1, int(self.server.bandwidth / 10))
+      for i in range(0, len(body), chunk_size):
+        self.wfile.write(body[i:i + chunk_size])
+        time.sleep(0.1)
+    self.server.count('bytes', len(body))
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  # latency is in seconds, bandwidth in bytes per second (per connection),
+  # and failure_rate and reset_rate are the fractions of requests answered with
+  # one of failure_statuses or by hanging up
+  def __init__(self, address, cache_dir=CACHE_DIR, page_size=20, latency=0, bandwidth=None, failure_rate=0, failure_statuses=(503,), reset_rate=0, verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+    self.cache_dir = cache_dir
+    self.listing_pages = load_listing(cache_dir, page_size)
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.failure_rate = failure_rate
+    self.failure_statuses = failure_statuses
+    self.reset_rate = reset_rate
+    self.verbose = verbose
+    self.counters = collections.Counter()
+    self.counters_lock = threading.Lock()
+
+  def count(self, counter, n=1):
+    with self.counters_lock:
+      self.counters[counter] += n
+
+  def base_url(self):
+    return 'http://%s:%d' % self.server_address
+
+  def lookup(self, path, query):
+    if path == LISTING_PATH:
+      page_num = int(query.get('page', ['0'])[0])
+      if page_num < len(self.listing_pages):
+        return self.listing_pages[page_num]
+      return render_listing_page([])
+
+    if path == SUMMARY_PATH:
+      summary_dir = os.path.join(self.cache_dir, 'summary')
+      snapshots = sorted(f for f in os.listdir(summary_dir) if f.endswith('.html'))
+      if not snapshots:
+        return None
+      return read_file(os.path.join(summary_dir, snapshots[-1]))
+
+    filename = os.path.join(self.cache_dir, '%s%s.html' % (CACHE_PREFIX, path.replace('/', '_')))
+    if os.path.exists(filename):
+      return read_file(filename)
+
+    return None
+
+def read_file(filename):
+  with open(filename, 'rb') as f:
+    return f.read()
+
+def add_fault_arguments(parser):
+  parser.add_argument('--latency', type=float, default=0, metavar='SECONDS',
+                      help='delay before answering each request (default: %(default)s)')
+  parser.add_argument('--bandwidth', type=float, default=None, metavar='KB_PER_SECOND',
+                      help='limit each response to this rate (default: unlimited)')
+  parser.add_argument('--failure-rate', type=float, default=0,
+                      help='fraction of requests answered with an error status (default: %(default)s)')
+  parser.add_argument('--failure-status', type=int, action='append',
+                      help='status to fail requests with, can be given more than once (default: 503)')
+  parser.add_argument('--reset-rate', type=float, default=0,
+                      help='fraction of requests where the connection is closed without an answer (default: %(default)s)')
+
+def fault_options(args):
+  return {
+    'latency': args.latency,
+    'bandwidth': args.bandwidth * 1024 if args.bandwidth else None,
+    'failure_rate': args.failure_rate,
+    'failure_statuses': args.failure_status or [503],
+    'reset_rate': args.reset_rate,
+  }
+
+def start_server(port=0, **kwargs):
+  # Runs the server on a background thread, for use from other scripts
+  server = StandinServer(('127.0.0.1', port), **kwargs)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument('--page-size', type=int, default=20,
+                      help='media releases per listing page (default: %(default)s)')
+  add_fault_arguments(parser)
+  args = parser.parse_args()
+
+  server = StandinServer(('127.0.0.1', args.port), page_size=args.page_size, verbose=True, **fault_options(args))
+  print 'Serving data_cache/ on %s' % server.base_url()
+  server.serve_forever()